@@ -0,0 +1,180 @@
+"""
+Times the pipeline stages of `helper_functions` on synthetic scenarios and
+records the results as JSON, e.g. from the repository root:
+
+    python -m benchmarks.run_benchmarks --scale small medium --repeat 3
+    python -m benchmarks.run_benchmarks --scale small --compare benchmarks/results/<commit>.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+import contextlib
+
+import numpy as np
+
+# The API helpers ask for keys at import; no network is used here
+os.environ.setdefault("MAPBOX_ACCESS_TOKEN", "benchmark")
+os.environ.setdefault("GOOGLE_ACCESS_KEY", "benchmark")
+
+from helper_functions.candidate_generation_helper import generate_candidates, generate_redundant_sites, sample_sets
+from helper_functions.hrsl_site_helper import make_site_set_hrsl_dict
+from helper_functions.demand_helper import compute_expected_demand
+from helper_functions.metrics_helper import (compute_exp_demand, compute_hospital_attractiveness, compute_site_attractiveness,
+                                             mapreduce, compute_metric_population_single, compute_metric_dist_decay_single)
+from benchmarks.scenarios import SCALES, make_scenario
+
+def git_commit():
+    """
+    Returns the current commit hash and whether the working tree has uncommitted changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return commit, dirty
+
+def time_stage(fn, repeat=3, seed=0):
+    """
+    Input:
+    - fn: Function without arguments running the stage once
+    - repeat: Number of timed runs
+    - seed: Random seed set before every run, so runs are identical
+
+    Output:
+    - Dictionary of the run times in seconds, and their minimum and median
+    """
+    times = []
+    for _ in range(repeat):
+        random.seed(seed)
+        np.random.seed(seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter()-start)
+    return {'times': times, 'best': min(times), 'median': float(np.median(times))}
+
+def candidate_spacing(mun, n_sites):
+    """
+    Returns the `generate_candidates` spacing that gives about n_sites candidates in mun
+    """
+    # `generate_candidates` steps 0.01*spacing degrees in both directions
+    return np.sqrt(mun['geometry'].iloc[0].area/n_sites)/0.01
+
+def make_stages(scenario, pop_col='population_2020'):
+    """
+    Input:
+    - scenario: Dictionary from `make_scenario`
+
+    Output:
+    - Dictionary of stage name to a function without arguments running the stage; the
+      inputs each stage needs are computed once beforehand
+    """
+    n_sites = len(scenario['sites'])
+    coords = list(scenario['site_coords'].values())
+    with contextlib.redirect_stdout(io.StringIO()):
+        random.seed(0)
+        redundant = generate_redundant_sites(coords)
+        site_sets = sample_sets(list(range(n_sites)), scenario['set_size'], scenario['n_sets'], redundant)
+    site_set_hrsl = make_site_set_hrsl_dict(scenario['site_hrsl'], site_sets.copy())
+    pop, time_matrix = scenario['matrix_pop'], scenario['time_matrix']
+    exp_demand = compute_exp_demand(pop, time_matrix, beds=20, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29)
+    hosp_attractiveness = compute_hospital_attractiveness(scenario['hosp_matrix'], scenario['hosp']['Bed Capacity'])
+    spacing = candidate_spacing(scenario['mun'], n_sites)
+
+    return {
+        'generate_candidates': lambda: generate_candidates(scenario['mun'], spacing=spacing),
+        'generate_redundant_sites': lambda: generate_redundant_sites(coords),
+        'sample_sets': lambda: sample_sets(list(range(n_sites)), scenario['set_size'], scenario['n_sets'], redundant),
+        'make_site_set_hrsl_dict': lambda: make_site_set_hrsl_dict(scenario['site_hrsl'], site_sets.copy()),
+        'compute_exp_demand': lambda: compute_exp_demand(pop, time_matrix, beds=20, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29),
+        'compute_expected_demand': lambda: compute_expected_demand(scenario['hrsl'].copy(), scenario['hosp'].copy(),
+                                                                   scenario['union'], pop_col),
+        'compute_site_attractiveness': lambda: compute_site_attractiveness(time_matrix, hosp_attractiveness, pop, beds=20),
+        'mapreduce_population': lambda: mapreduce(site_set_hrsl, compute_metric_population_single),
+        'mapreduce_dist_decay': lambda: mapreduce(site_set_hrsl, lambda dct: compute_metric_dist_decay_single(dct, pop, exp_demand)),
+    }
+
+def run(scales, repeat=3, stages=None, seed=0):
+    """
+    Input:
+    - scales: Names of scales in SCALES
+    - repeat: Number of timed runs per stage
+    - stages: Names of the stages to time, all if None
+    - seed: Scenario and stage random seed
+
+    Output:
+    - Dictionary of the environment, commit, and per scale the scenario sizes and stage timings
+    """
+    commit, dirty = git_commit()
+    result = {'commit': commit, 'dirty': dirty, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'cpu_count': os.cpu_count(), 'repeat': repeat, 'seed': seed, 'scales': {}}
+    for scale in scales:
+        params = SCALES[scale]
+        start = time.perf_counter()
+        scenario = make_scenario(seed=seed, **params)
+        stage_fns = make_stages(scenario)
+        entry = {'params': params, 'time_matrix_shape': list(scenario['time_matrix'].shape),
+                 'setup_seconds': time.perf_counter()-start, 'stages': {}}
+        for (name, fn) in stage_fns.items():
+            if stages and name not in stages:
+                continue
+            entry['stages'][name] = time_stage(fn, repeat, seed)
+            print(f"{scale:>8} {name:<28} {entry['stages'][name]['best']:10.4f} s", file=sys.stderr)
+        result['scales'][scale] = entry
+    return result
+
+def compare(base, new, threshold=1.10):
+    """
+    Input:
+    - base, new: Results from `run` (e.g. loaded from JSON of two commits)
+    - threshold: Ratio of best times above which a stage is flagged as a regression
+
+    Output:
+    - List of (scale, stage, base seconds, new seconds, ratio, flag) for the stages in both
+    """
+    rows = []
+    for (scale, entry) in new['scales'].items():
+        for (stage, timing) in entry['stages'].items():
+            if stage in base['scales'].get(scale, {}).get('stages', {}):
+                old = base['scales'][scale]['stages'][stage]['best']
+                ratio = timing['best']/old if old > 0 else float('inf')
+                flag = 'slower' if ratio > threshold else ('faster' if ratio < 1/threshold else '')
+                rows.append((scale, stage, old, timing['best'], ratio, flag))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the helper_functions pipeline stages on synthetic scenarios")
+    parser.add_argument('--scale', nargs='+', default=['small'], choices=list(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=None, help="Stages to time, all by default")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON file, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument('--compare', default=None, help="JSON results of another commit to compare against")
+    args = parser.parse_args(argv)
+
+    result = run(args.scale, args.repeat, args.stages, args.seed)
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{(result['commit'] or 'unknown')[:10]}{'-dirty' if result['dirty'] else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        print(f"{'scale':>8} {'stage':<28} {'base':>10} {'new':>10} {'ratio':>7}")
+        for (scale, stage, old, new, ratio, flag) in compare(base, result):
+            print(f"{scale:>8} {stage:<28} {old:10.4f} {new:10.4f} {ratio:7.2f} {flag}")
+
+if __name__ == '__main__':
+    main()
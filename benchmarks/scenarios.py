@@ -0,0 +1,143 @@
+import pandas as pd
+import shapely
+import numpy as np
+import geopandas as gpd
+
+import random
+
+# Scenario sizes used by `run_benchmarks.py`
+SCALES = {
+    'small': {'n_sites': 100, 'n_hrsl': 1000, 'n_sets': 1000},
+    'medium': {'n_sites': 1000, 'n_hrsl': 100000, 'n_sets': 10000},
+    'large': {'n_sites': 10000, 'n_hrsl': 1000000, 'n_sets': 100000},
+}
+
+def make_municipality(center=(121.18, 14.62), radius=0.15, n_vertices=40, seed=0):
+    """
+    Input:
+    - center: (lon, lat) of the municipality
+    - radius: Mean radius in decimal degrees
+    - n_vertices: Number of polygon vertices
+    - seed: Random seed
+
+    Output:
+    - mun: Geodataframe with one irregular polygon, as the merged municipality in the notebooks
+    """
+    rng = np.random.default_rng(seed)
+    angles = np.sort(rng.uniform(0, 2*np.pi, n_vertices))
+    radii = radius*rng.uniform(0.6, 1.0, n_vertices)
+    polygon = shapely.Polygon(np.column_stack([center[0]+radii*np.cos(angles), center[1]+radii*np.sin(angles)]))
+    return gpd.GeoDataFrame({'ISO': ['PHL'], 'NAME_2': ['Synthetic']}, geometry=[polygon], crs='EPSG:4326')
+
+def sample_points(polygon, n, rng, n_towns=8, spread=0.02):
+    """
+    Input:
+    - polygon: Shapely polygon
+    - n: Number of points
+    - rng: Numpy random generator
+    - n_towns: Number of population clusters; half of the points are drawn around them
+    - spread: Standard deviation of the clusters in decimal degrees
+
+    Output:
+    - lon, lat: Arrays of n points inside the polygon
+    """
+    min_x, min_y, max_x, max_y = polygon.bounds
+    towns = np.column_stack([rng.uniform(min_x, max_x, n_towns), rng.uniform(min_y, max_y, n_towns)])
+    lon, lat = np.zeros(0), np.zeros(0)
+    while len(lon) < n:
+        m = 2*(n-len(lon))
+        clustered = towns[rng.integers(0, n_towns, m//2)] + rng.normal(0, spread, (m//2, 2))
+        uniform = np.column_stack([rng.uniform(min_x, max_x, m-m//2), rng.uniform(min_y, max_y, m-m//2)])
+        xy = np.vstack([clustered, uniform])
+        xy = xy[shapely.contains_xy(polygon, xy[:,0], xy[:,1])]
+        lon, lat = np.concatenate([lon, xy[:,0]]), np.concatenate([lat, xy[:,1]])
+    order = rng.permutation(len(lon))[:n]
+    return lon[order], lat[order]
+
+def travel_times(src_lon, src_lat, dst_lon, dst_lat, rng, speed=30, detour=1.3, block_size=10000):
+    """
+    Output:
+    - n_sources x n_destinations matrix of synthetic drive times in minutes, from the
+      haversine distance at `speed` km/h times a random detour factor around `detour`
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [src_lon, src_lat, dst_lon, dst_lat])
+    result = np.zeros((len(lon1), len(lon2)))
+    for i in range(0, len(lon1), block_size):
+        a = (np.sin((lat2[np.newaxis]-lat1[i:i+block_size, np.newaxis])/2)**2 +
+             np.cos(lat1[i:i+block_size, np.newaxis])*np.cos(lat2[np.newaxis])*
+             np.sin((lon2[np.newaxis]-lon1[i:i+block_size, np.newaxis])/2)**2)
+        km = 2*np.arcsin(np.sqrt(a))*6371
+        result[i:i+block_size] = km/speed*60*rng.uniform(1, 2*detour-1, km.shape)
+    return result
+
+def make_scenario(n_sites=100, n_hrsl=1000, n_hosp=5, n_sets=1000, set_size=3,
+                  max_matrix_cells=2*10**7, seed=0, pop_col='population_2020'):
+    """
+    Input:
+    - n_sites: Number of candidate sites
+    - n_hrsl: Number of HRSL population points
+    - n_hosp: Number of existing hospitals
+    - n_sets, set_size: Number and size of the site sets to evaluate
+    - max_matrix_cells: Largest travel time matrix built; beyond it the matrix covers
+                        only the first max_matrix_cells/n_sites HRSL points
+    - seed: Random seed, so every run of a scenario is identical
+
+    Output:
+    Dictionary with
+    - mun: Municipality geodataframe
+    - hrsl: HRSL geodataframe with longitude, latitude, pop_col and geometry columns
+    - sites: Geodataframe of candidate sites with index, geometry (30 minute isochrone),
+             i30 and i60 columns, as read back in the notebooks
+    - site_coords: Dictionary of site ID to shapely point
+    - site_hrsl: Dictionary as from `make_site_hrsl_dict`
+    - hosp: Geodataframe of hospitals with 30 minute isochrones as geometry, and
+            capacity and Bed Capacity columns
+    - union: Union of the hospital isochrones
+    - time_matrix: HRSL x sites drive time matrix (possibly for a subset of HRSL rows)
+    - hosp_matrix: HRSL x hospitals drive time matrix for the same rows
+    - matrix_pop: Populations of the rows of the matrices
+    - set_size, n_sets: As given
+    """
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    mun = make_municipality(seed=seed)
+    polygon = mun['geometry'].iloc[0]
+
+    # Population points, lognormal populations as in HRSL
+    lon, lat = sample_points(polygon, n_hrsl, rng)
+    hrsl = pd.DataFrame({'longitude': lon, 'latitude': lat, pop_col: rng.lognormal(1.5, 1.0, n_hrsl)})
+    hrsl = gpd.GeoDataFrame(hrsl, geometry=shapely.points(lon, lat), crs='EPSG:4326')
+
+    # Candidate sites with circular 30 and 60 minute isochrones
+    site_lon, site_lat = sample_points(polygon, n_sites, rng)
+    points = shapely.points(site_lon, site_lat)
+    r30 = rng.uniform(0.02, 0.06, n_sites)
+    i30, i60 = shapely.buffer(points, r30), shapely.buffer(points, 2*r30)
+    sites = gpd.GeoDataFrame({'index': np.arange(n_sites), 'i30': i30, 'i60': i60},
+                             geometry=i30, crs='EPSG:4326')
+    site_coords = {i: pt for (i, pt) in enumerate(points)}
+
+    # HRSL points within each site's 30 minute isochrone, as the left join of `make_site_hrsl_dict`
+    site_idx, hrsl_idx = shapely.STRtree(hrsl['geometry'].values).query(i30, predicate='contains')
+    pop = hrsl[pop_col].values
+    site_hrsl = {i: [(np.nan, np.nan)] for i in range(n_sites)}
+    covered = {}
+    for (s, h) in zip(site_idx, hrsl_idx):
+        covered.setdefault(int(s), []).append((int(h), pop[h]))
+    site_hrsl.update(covered)
+
+    # Hospitals
+    hosp_lon, hosp_lat = sample_points(polygon, n_hosp, rng)
+    hosp_points = shapely.points(hosp_lon, hosp_lat)
+    hosp = gpd.GeoDataFrame({'capacity': np.full(n_hosp, 20000.0), 'Bed Capacity': np.full(n_hosp, 20.0)},
+                            geometry=shapely.buffer(hosp_points, 0.04), crs='EPSG:4326')
+    union = shapely.union_all(hosp['geometry'].values)
+
+    # Travel time matrices, capped in size
+    n_rows = int(min(n_hrsl, max(1, max_matrix_cells//max(n_sites, 1))))
+    time_matrix = travel_times(lon[:n_rows], lat[:n_rows], site_lon, site_lat, rng)
+    hosp_matrix = travel_times(lon[:n_rows], lat[:n_rows], hosp_lon, hosp_lat, rng)
+
+    return {'mun': mun, 'hrsl': hrsl, 'sites': sites, 'site_coords': site_coords, 'site_hrsl': site_hrsl,
+            'hosp': hosp, 'union': union, 'time_matrix': time_matrix, 'hosp_matrix': hosp_matrix,
+            'matrix_pop': pop[:n_rows], 'set_size': set_size, 'n_sets': n_sets}
@@ -0,0 +1,145 @@
+import numpy as np
+import shapely
+import sqlite3
+import hashlib
+
+from helper_functions.mapbox_helper import *
+from helper_functions.instrumentation_helper import record_cache_lookup
+
+# Running totals of cache lookups and network fetches
+cache_stats = {'hits': 0, 'misses': 0, 'fetches': 0}
+
+def reset_cache_stats():
+    for key in cache_stats:
+        cache_stats[key] = 0
+
+def open_cache(path="data/mapbox_cache.sqlite"):
+    """
+    Input:
+    - path: SQLite file holding the cached travel times and isochrones
+
+    Output:
+    - cache: sqlite3 connection, with the tables created if needed
+    """
+    cache = sqlite3.connect(path)
+    cache.execute("CREATE TABLE IF NOT EXISTS travel_times (key TEXT PRIMARY KEY, minutes REAL)")
+    cache.execute("CREATE TABLE IF NOT EXISTS isochrones (key TEXT PRIMARY KEY, iso30 BLOB, iso60 BLOB)")
+    cache.commit()
+    return cache
+
+def cache_key(profile, *coords, precision=5):
+    """
+    Input:
+    - profile: Mapbox routing profile
+    - coords: (lon, lat) tuples
+    - precision: Number of decimals the coordinates are rounded to
+
+    Output:
+    - Hash of the profile and rounded coordinates, so points within
+      ~1 m (at 5 decimals) share a cache entry
+    """
+    text = profile + "|" + "|".join(f"{round(lon, precision):.{precision}f},{round(lat, precision):.{precision}f}"
+                                     for (lon, lat) in coords)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def _lookup(cache, table, columns, keys, batch_size=500):
+    """
+    Returns a dictionary of the cached rows among `keys`
+    """
+    found = {}
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i+batch_size]
+        rows = cache.execute(f"SELECT key, {columns} FROM {table} WHERE key IN ({','.join('?'*len(batch))})", batch)
+        found.update({row[0]:row[1:] for row in rows})
+    return found
+
+def cached_driving_time(sources, destinations, cache, access=access, base_url=MAPBOX_URL,
+                        profile='driving', precision=5, fetch=driving_time):
+    """
+    Input:
+    - sources: List of shapely coordinates
+    - destinations: List of shapely coordinates
+    - cache: Connection from `open_cache`
+    - access: Mapbox access token
+    - base_url: Base URL of the API
+    - profile: Mapbox routing profile
+    - precision: Number of decimals the coordinates are rounded to for the cache key
+    - fetch: Function returning the travel time matrix for missing cells, with the
+             signature of `driving_time`
+
+    Output:
+    - result: n_sources x n_destinations matrix pertaining to drive times in minutes
+
+    Note:
+    Every cell is looked up by its own key; sources missing the same destinations
+    are fetched together, so only missing cells are sent to `fetch` (one call per
+    distinct set of missing destinations); `cache_stats` counts the hits and misses
+    """
+    src = [(pt.x, pt.y) for pt in sources]
+    dst = [(pt.x, pt.y) for pt in destinations]
+    keys = [[cache_key(profile, s, d, precision=precision) for d in dst] for s in src]
+    found = _lookup(cache, 'travel_times', 'minutes', [key for row in keys for key in row])
+
+    result = np.full((len(src), len(dst)), np.nan)
+    missing = np.zeros((len(src), len(dst)), dtype=bool)
+    for i in range(len(src)):
+        for j in range(len(dst)):
+            if keys[i][j] in found:
+                minutes = found[keys[i][j]][0]
+                result[i][j] = np.nan if minutes is None else minutes
+            else:
+                missing[i][j] = True
+    cache_stats['hits'] += int((~missing).sum())
+    cache_stats['misses'] += int(missing.sum())
+    record_cache_lookup('mapbox-matrix', int((~missing).sum()), int(missing.sum()))
+
+    # Group the sources by the destinations they miss, and fetch one block per group
+    groups = {}
+    for i in np.flatnonzero(missing.any(axis=1)):
+        groups.setdefault(missing[i].tobytes(), []).append(i)
+    for rows in groups.values():
+        cols = np.flatnonzero(missing[rows[0]])
+        fetched = fetch([sources[i] for i in rows], [destinations[j] for j in cols],
+                        access=access, base_url=base_url, profile=profile)
+        cache_stats['fetches'] += 1
+
+        entries = []
+        for (a, i) in enumerate(rows):
+            for (b, j) in enumerate(cols):
+                minutes = float(fetched[a][b])
+                result[i][j] = minutes
+                entries.append((keys[i][j], None if np.isnan(minutes) else minutes))
+        cache.executemany("INSERT OR REPLACE INTO travel_times VALUES (?, ?)", entries)
+        cache.commit()
+    return result
+
+def cached_isochrone(lon, lat, cache, access=access, base_url=MAPBOX_URL, profile='walking', precision=5):
+    """
+    Input:
+    - lon, lat: Coordinates of the site
+    - cache: Connection from `open_cache`
+    - access: Mapbox access token
+    - base_url: Base URL of the API
+    - profile: Mapbox routing profile
+    - precision: Number of decimals the coordinates are rounded to for the cache key
+
+    Output:
+    - iso30, iso60: 30 and 60 minute isochrone polygons as from `isochrone`;
+      failed requests (None polygons) are not cached
+    """
+    key = cache_key(profile, (lon, lat), precision=precision)
+    found = _lookup(cache, 'isochrones', 'iso30, iso60', [key])
+    if key in found:
+        cache_stats['hits'] += 1
+        record_cache_lookup('mapbox-isochrone', hits=1)
+        return tuple(shapely.from_wkb(blob) for blob in found[key])
+
+    cache_stats['misses'] += 1
+    record_cache_lookup('mapbox-isochrone', misses=1)
+    cache_stats['fetches'] += 1
+    iso30, iso60 = isochrone(lon, lat, access=access, base_url=base_url, profile=profile)
+    if iso30 is not None and iso60 is not None:
+        cache.execute("INSERT OR REPLACE INTO isochrones VALUES (?, ?, ?)",
+                      (key, shapely.to_wkb(iso30), shapely.to_wkb(iso60)))
+        cache.commit()
+    return iso30, iso60
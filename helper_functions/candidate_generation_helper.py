@@ -4,6 +4,11 @@ import numpy as np
 import geopandas as gpd
 import requests
 import itertools
+import math
+import time
+import warnings
+import scipy.sparse
+from scipy.spatial import cKDTree
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -11,6 +16,7 @@ import matplotlib.pyplot as plt
 import random
 
 from helper_functions.mapbox_helper import *
+from helper_functions.instrumentation_helper import stage_span, instrumented_stage
 
 def bounding_box(polygon):
     if 'MultiPolygon' in str(type(polygon)):
@@ -25,6 +31,7 @@ def bounding_box(polygon):
         min_x = min(polygon.exterior.coords.xy[0])
     return max_y, min_y, max_x, min_x
 
+@instrumented_stage()
 def generate_candidates(gdf, sample_size=None, spacing=1):
     """
     Input: 
@@ -55,6 +62,92 @@ def generate_candidates(gdf, sample_size=None, spacing=1):
     all_sites = gpd.GeoDataFrame({'geometry':sites}, geometry=sites, crs='EPSG:4326').reset_index()
     return all_sites
 
+def _densify(x, y, size, hrsl_x, hrsl_y, hrsl_pop, quantile, levels):
+    """
+    Adds points on a grid twice as fine inside the cells (of width `size`, anchored
+    at the lowest x and y) whose population is at or above the given quantile of 
+    populated cells, repeating `levels` times
+    """
+    new_x, new_y = [], []
+    origin_x, origin_y = min(x.min(), hrsl_x.min()), min(y.min(), hrsl_y.min())
+    for _ in range(levels):
+        # Population per grid cell
+        cx = np.floor((hrsl_x-origin_x)/size).astype(np.int64)
+        cy = np.floor((hrsl_y-origin_y)/size).astype(np.int64)
+        cells, inverse = np.unique(np.column_stack([cx, cy]), axis=0, return_inverse=True)
+        cell_pop = np.bincount(inverse.ravel(), weights=hrsl_pop)
+        if not (cell_pop > 0).any():
+            break
+        dense = cells[cell_pop >= np.quantile(cell_pop[cell_pop > 0], quantile)]
+        
+        # Four points per dense cell at the centers of its quadrants
+        offsets = np.array([[0.25,0.25],[0.25,0.75],[0.75,0.25],[0.75,0.75]])
+        points = (dense[:,np.newaxis,:] + offsets[np.newaxis]).reshape(-1, 2)*size
+        new_x.append(points[:,0]+origin_x)
+        new_y.append(points[:,1]+origin_y)
+        size = size/2
+    if not new_x:
+        return x, y
+    return np.concatenate([x]+new_x), np.concatenate([y]+new_y)
+
+@instrumented_stage()
+def generate_candidates_vectorized(gdf, sample_size=None, spacing=1, grid='square', 
+                                   hrsl=None, pop_col='population_2020', quantile=0.9, levels=1):
+    """
+    Input: 
+    - gdf: Geodataframe, geometry corresponds to LGU polygon(s)
+    - sample_size: Number of candidates to randomly keep, optional
+    - spacing: Grid spacing in units of 0.01 degrees, as in `generate_candidates`
+    - grid: 'square' for the same grid as `generate_candidates`, or 'hex' for a
+            hexagonal grid with the same spacing between neighbouring points
+    - hrsl: HRSL (geo)dataframe with longitude/latitude or point geometry; if given,
+            cells with high population get additional, finer candidates
+    - pop_col: Population column of hrsl
+    - quantile: Populated cells at or above this population quantile are densified
+    - levels: Number of times dense cells are subdivided
+    
+    Output: 
+    Geodataframe, geometry corresponds to coordinates of candidate sites
+    
+    Note:
+    Points are tested against the prepared union of the geometries in one 
+    vectorized `contains_xy` call instead of one shapely Point per grid cell
+    """
+    polygon = shapely.union_all(gdf['geometry'].values)
+    shapely.prepare(polygon)
+    min_x, min_y, max_x, max_y = polygon.bounds
+    step = 0.01*spacing
+    
+    # Generate grid coordinates
+    if grid=='hex':
+        dy = step*np.sqrt(3)/2
+        rows = np.arange(0, max_y-min_y+dy, dy)
+        cols = np.arange(0, max_x-min_x+step, step)
+        x = (min_x + cols[np.newaxis,:] + (np.arange(len(rows))%2)[:,np.newaxis]*step/2).flatten()
+        y = np.repeat(min_y + rows, len(cols))
+    else:
+        xs = np.linspace(min_x, max_x, round((max_x-min_x)/step))
+        ys = np.linspace(min_y, max_y, round((max_y-min_y)/step))
+        x, y = [v.flatten() for v in np.meshgrid(xs, ys, indexing='ij')]
+    
+    # Add finer candidates where the population is high
+    if hrsl is not None:
+        if 'longitude' in hrsl.columns:
+            hrsl_x, hrsl_y = hrsl['longitude'].values, hrsl['latitude'].values
+        else:
+            hrsl_x, hrsl_y = shapely.get_coordinates(hrsl['geometry'].values).T
+        hrsl_pop = np.nan_to_num(hrsl[pop_col].values.astype(float))
+        x, y = _densify(x, y, step, hrsl_x, hrsl_y, hrsl_pop, quantile, levels)
+    
+    inside = shapely.contains_xy(polygon, x, y)
+    sites = shapely.points(x[inside], y[inside])
+    
+    if sample_size:
+        sites = random.sample(list(sites), sample_size)
+        
+    all_sites = gpd.GeoDataFrame({'geometry':sites}, geometry=sites, crs='EPSG:4326').reset_index()
+    return all_sites
+
 def add_record(d, lst):
     """
     Function that checks if a record is already present in a dictionary
@@ -83,41 +176,299 @@ def sample_sets(lst, set_size, n_results, redundant_dict):
     Output:
     Dataframe with Set IDs (set_id) and sets (site_set)
     """
-    print("Generating candidates")
-    if n_results=='all':
-        result = list(itertools.combinations(lst, set_size))
-    else:
-        count = 0
-        result = []
-        records = {}
-        while count < n_results:
-            test = sorted(random.sample(lst, set_size))
-            if add_record(records, test):
-                if check_valid_candidate(test, redundant_dict):
-                    result.append(test)
-                    count += 1
-    print("Generating dataframe")
+    with stage_span('sample_sets', total=None if n_results=='all' else n_results) as span:
+        if n_results=='all':
+            result = list(itertools.combinations(lst, set_size))
+            span.advance(len(result))
+        else:
+            count = 0
+            result = []
+            records = {}
+            while count < n_results:
+                test = sorted(random.sample(lst, set_size))
+                if add_record(records, test):
+                    if check_valid_candidate(test, redundant_dict):
+                        result.append(test)
+                        count += 1
+                        span.advance()
     result = pd.DataFrame([(i,item) for (i,item) in enumerate(result)], 
                           columns=['set_id','site_set'])
     return result
 
-def generate_redundant_sites(lst, threshold=2):
-    # Generate distance matrix
-    site_site_mat = np.zeros((len(lst),len(lst)))
-    for i in range(len(lst)):
-        site_site_mat[i] = list(map(lambda p: haversine(lst[i], p), lst))
+def redundancy_matrix(lst, redundant_dict):
+    """
+    Inputs:
+    - lst: List of site ids
+    - redundant_dict: Dictionary containing site ids as keys, 
+    and list of redundant sites as a list (value)
+    
+    Output:
+    Boolean matrix where entry (i, j) is True if lst[j] is redundant to lst[i]
+    """
+    positions = {site:i for (i,site) in enumerate(lst)}
+    conflict = np.zeros((len(lst), len(lst)), dtype=bool)
+    for (site, redundant) in redundant_dict.items():
+        if site in positions:
+            cols = [positions[item] for item in redundant if item in positions]
+            conflict[positions[site], cols] = True
+    return conflict
+
+def iter_site_set_blocks(lst, set_size, redundant_dict, block_size=100000):
+    """
+    Inputs:
+    - lst: List of site ids
+    - set_size: Size of each candidate set
+    - redundant_dict: Dictionary containing site ids as keys, 
+    and list of redundant sites as a list (value)
+    - block_size: Number of combinations enumerated per block
+    
+    Output:
+    Generator of (n x set_size) integer arrays of site sets, in the same order as
+    itertools.combinations(lst, set_size) and keeping only sets that pass 
+    `check_valid_candidate`; memory stays bounded by block_size, and blocks can be
+    passed straight to `mapreduce_parallel`. Progress is reported by the
+    'iter_site_set_blocks' stage span
+    """
+    site_ids = np.asarray(lst)
+    conflict = redundancy_matrix(lst, redundant_dict)
+    pairs = list(itertools.combinations(range(set_size), 2))
+    
+    combos = itertools.combinations(range(len(site_ids)), set_size)
+    with stage_span('iter_site_set_blocks', total=math.comb(len(site_ids), set_size)) as span:
+        kept = 0
+        while True:
+            block = np.fromiter(itertools.islice(combos, block_size), 
+                                dtype=np.dtype((np.int64, set_size)))
+            if len(block)==0:
+                break
+                
+            # Drop sets where an earlier site is redundant to a later one
+            valid = np.ones(len(block), dtype=bool)
+            for (i, j) in pairs:
+                valid &= ~conflict[block[:,i], block[:,j]]
+            block = block[valid]
+            
+            kept += len(block)
+            span.advance(valid.size)
+            span.record(valid=kept)
+            yield site_ids[block]
+
+def sample_independent_sets(lst, set_size, n_results, redundant_dict, seed=None, max_draws=None, 
+                            return_stats=False, adjacency=None, steps_per_set=None, burn_in=None):
+    """
+    Inputs:
+    - lst: List of site ids
+    - set_size: Size of each candidate set
+    - n_results: Number of candidate sets to generate
+    - redundant_dict: Dictionary containing site ids as keys, 
+    and list of redundant sites as a list (value)
+    - seed: Seed for the random generator
+    - max_draws: Maximum number of swap proposals before giving up, 
+    defaults to burn_in + 100*steps_per_set*n_results
+    - return_stats: Whether to also return the acceptance statistics
+    - adjacency: Sparse redundancy matrix over the positions of lst, e.g. from
+    `redundant_sites_adjacency`; built from redundant_dict if None
+    - steps_per_set: Swap proposals between two returned sets, defaults to 10*set_size
+    - burn_in: Swap proposals before the first returned set, defaults to 10*steps_per_set
+    
+    Output:
+    Dataframe with Set IDs (set_id) and sets (site_set), as in `sample_sets`;
+    if return_stats, a tuple (dataframe, stats dictionary)
+    
+    Note:
+    A first valid set is drawn site by site from the sites not yet redundant with 
+    the chosen ones. It is then moved by a random walk over valid sets: each step 
+    proposes to replace a uniformly chosen member with a uniformly chosen site, and 
+    is taken if the new set passes `check_valid_candidate`. The proposals are 
+    symmetric, so the walk's stationary distribution is uniform over valid sets 
+    (unlike site by site drawing, which favours sites with many redundant 
+    neighbours); a set is returned every steps_per_set proposals, skipping repeats. 
+    Each proposal costs O(1) plus O(degree) when taken, so the time per set stays 
+    bounded however dense the redundancy graph. If max_draws is reached first, 
+    fewer than n_results sets are returned with a warning
+    """
+    rng = np.random.default_rng(seed)
+    site_ids = np.asarray(lst)
+    n = len(site_ids)
+    adjacency = redundant_dict_to_adjacency(lst, redundant_dict) if adjacency is None else adjacency
+    # Symmetric, without self loops
+    adjacency = scipy.sparse.triu(scipy.sparse.csr_matrix(adjacency, dtype=bool), k=1) + \
+                scipy.sparse.tril(scipy.sparse.csr_matrix(adjacency, dtype=bool), k=-1).T
+    adjacency = scipy.sparse.csr_matrix(adjacency + adjacency.T, dtype=bool)
+    adjacency.sort_indices()
+    neighbours = [adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]] for i in range(n)]
+    
+    # Sorted positions map exactly to one integer if n^set_size fits in 63 bits
+    exact_keys = set_size*math.log2(max(n, 2)) < 63
+    weights = n**np.arange(set_size, dtype=np.int64) if exact_keys else None
+    
+    steps_per_set = steps_per_set if steps_per_set else 10*set_size
+    burn_in = burn_in if burn_in is not None else 10*steps_per_set
+    max_draws = max_draws if max_draws else burn_in + 100*steps_per_set*n_results
+    
+    with stage_span('sample_independent_sets', total=n_results) as span:
+        records, result = set(), []
+        draws, moves, duplicates, restarts, start = 0, 0, 0, 0, time.time()
         
-    # Identify pairs whose distance is below the threshold
-    xs, ys = (site_site_mat < threshold).nonzero()
+        # Starting set, drawn site by site; restart on dead ends
+        chosen = []
+        while len(chosen) < set_size and draws < max_draws and n >= set_size:
+            draws += 1
+            available = np.ones(n, dtype=bool)
+            chosen = []
+            for _ in range(set_size):
+                candidates = np.flatnonzero(available)
+                if len(candidates)==0:
+                    restarts += 1
+                    break
+                pick = int(candidates[rng.integers(len(candidates))])
+                chosen.append(pick)
+                available[pick] = False
+                available[neighbours[pick]] = False
+        
+        if len(chosen)==set_size:
+            # Number of chosen sites each site is redundant with
+            blocked = np.zeros(n, dtype=np.int64)
+            for pick in chosen:
+                blocked[neighbours[pick]] += 1
+            in_set = np.zeros(n, dtype=bool)
+            in_set[chosen] = True
+            
+            next_sample = draws + burn_in
+            while len(result) < n_results and draws < max_draws:
+                batch = min(steps_per_set, max_draws-draws)
+                for (r, l) in zip(rng.integers(0, set_size, batch).tolist(), rng.integers(0, n, batch).tolist()):
+                    if in_set[l] or blocked[l] > 1:
+                        continue
+                    j = chosen[r]
+                    if blocked[l]==1 and not (j in neighbours[l]):
+                        continue
+                    blocked[neighbours[j]] -= 1
+                    blocked[neighbours[l]] += 1
+                    in_set[j], in_set[l] = False, True
+                    chosen[r] = l
+                    moves += 1
+                draws += batch
+                if draws < next_sample:
+                    continue
+                next_sample = draws + steps_per_set
+                
+                current = np.sort(chosen)
+                key = int(current @ weights) if exact_keys else hash(current.tobytes())
+                if key in records:
+                    duplicates += 1
+                    continue
+                records.add(key)
+                result.append(site_ids[current].tolist())
+                span.advance()
+    
+        elapsed = time.time()-start
+        stats = {'accepted': len(result), 'draws': draws, 'moves': moves, 'duplicates': duplicates,
+                 'restarts': restarts, 'move_rate': moves/max(draws, 1),
+                 'seconds_per_accepted': elapsed/max(len(result), 1)}
+        span.record(**stats)
+    if len(result) < n_results:
+        warnings.warn(f"Only {len(result)} of {n_results} site sets found in {draws} draws; "
+                      f"increase max_draws or check that enough valid sets exist")
+    
+    result = pd.DataFrame([(i,item) for (i,item) in enumerate(result)], 
+                          columns=['set_id','site_set'])
+    if return_stats:
+        return result, stats
+    return result
+
+def redundant_sites_adjacency(lst, thresholds=(2,)):
+    """
+    Inputs:
+    - lst: List of site coordinates (shapely points or (lon, lat) tuples)
+    - thresholds: List of distances in kilometers
+    
+    Output:
+    List of n_sites x n_sites sparse boolean matrices, one per threshold, 
+    True where two different sites are closer than the threshold
+    
+    Note:
+    One KD-tree over the sites on the unit sphere is queried once at the largest
+    threshold; the haversine distance of each returned pair is then compared
+    against every threshold
+    """
+    lon, lat = point_coords(lst)
+    n = len(lon)
+    tree = cKDTree(lonlat_to_xyz(lon, lat))
+    pairs = tree.query_pairs(km_to_chord(max(thresholds))*(1+1e-9), output_type='ndarray')
+    dist = haversine_vectorized(lon[pairs[:,0]], lat[pairs[:,0]], lon[pairs[:,1]], lat[pairs[:,1]])
+    
+    result = []
+    for threshold in thresholds:
+        close = pairs[dist < threshold]
+        rows = np.concatenate([close[:,0], close[:,1]])
+        cols = np.concatenate([close[:,1], close[:,0]])
+        adjacency = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n))
+        adjacency.sort_indices()
+        result.append(adjacency)
+    return result
+
+def adjacency_to_redundant_dict(adjacency):
+    """
+    Input:
+    - adjacency: Sparse matrix from `redundant_sites_adjacency`
+    
+    Output:
+    Dictionary with site position as key, and list of redundant site positions as value,
+    for every site with at least one redundant site
+    """
     d = {}
-    for (x,y) in zip(xs,ys):
-        if x!=y:
-            if x in d:
-                d[x].append(y)
-            else:
-                d[x] = [y]
+    for i in range(adjacency.shape[0]):
+        row = adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i+1]]
+        if len(row):
+            d[i] = row.tolist()
     return d
 
+def redundant_dict_to_adjacency(lst, redundant_dict):
+    """
+    Inputs:
+    - lst: List of site ids
+    - redundant_dict: Dictionary containing site ids as keys, 
+    and list of redundant sites as a list (value)
+    
+    Output:
+    n_sites x n_sites sparse boolean matrix over the positions of lst, True where 
+    lst[j] is redundant to lst[i]; the sparse counterpart of `redundancy_matrix`
+    """
+    positions = {site:i for (i,site) in enumerate(lst)}
+    pairs = [(positions[site], positions[item]) for (site, redundant) in redundant_dict.items() if site in positions
+             for item in redundant if item in positions]
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    adjacency = scipy.sparse.csr_matrix((np.ones(len(pairs), dtype=bool), (pairs[:,0], pairs[:,1])),
+                                        shape=(len(lst), len(lst)))
+    adjacency.sum_duplicates()
+    return adjacency
+
+@instrumented_stage(items=lambda lst, *args, **kwargs: len(lst))
+def generate_redundant_sites(lst, threshold=2):
+    """
+    Inputs:
+    - lst: List of site coordinates (shapely points or (lon, lat) tuples)
+    - threshold: Distance in kilometers below which two sites are redundant
+    
+    Output:
+    Dictionary with site position as key, and list of site positions 
+    closer than the threshold as value
+    """
+    return adjacency_to_redundant_dict(redundant_sites_adjacency(lst, [threshold])[0])
+
+def generate_redundant_sites_multi(lst, thresholds):
+    """
+    Inputs:
+    - lst: List of site coordinates (shapely points or (lon, lat) tuples)
+    - thresholds: List of distances in kilometers
+    
+    Output:
+    List of dictionaries as from `generate_redundant_sites`, one per threshold,
+    computed from a single spatial index
+    """
+    return [adjacency_to_redundant_dict(adjacency) for adjacency in redundant_sites_adjacency(lst, thresholds)]
+
 def check_valid_candidate(candidate, d):
     for i in range(len(candidate)):
         if candidate[i] not in d:
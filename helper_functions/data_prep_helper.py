@@ -4,25 +4,82 @@ import numpy as np
 import geopandas as gpd
 import requests
 import itertools
+import os
+import time
 
 import matplotlib
 import matplotlib.pyplot as plt
 
 import random
+from concurrent.futures import ThreadPoolExecutor
 from helper_functions.mapbox_helper import * 
+from helper_functions.routing_client_helper import make_rate_limiter, request_with_retry
+from helper_functions.road_network_helper import local_isochrones
+from helper_functions.instrumentation_helper import record_api_call
 
-print("Google Access Key:")
-google_access = input()
+# Base URLs of the APIs, can point to a local server for testing
+GOOGLE_MAPS_URL = "https://maps.googleapis.com"
+GOOGLE_ROADS_URL = "https://roads.googleapis.com"
 
-def geocode(address, prov="", country="Philippines", access=google_access):
-    x = requests.get(f"https://maps.googleapis.com/maps/api/geocode/json?address={address},{prov},{country}&key={access}")
-    x = x.json()
+# Read the access key from the environment if set, otherwise ask for it
+google_access = os.environ.get("GOOGLE_ACCESS_KEY")
+if not google_access:
+    print("Google Access Key:")
+    google_access = input()
+
+def parse_geocode(x):
     coords = x['results'][0]['geometry']['location']
     prec = x['results'][0]['geometry']['location_type']
     lat, lon = coords['lat'], coords['lng']
     return lon, lat, prec
 
-def nearest_road(coords, google_access=google_access):
+def geocode(address, prov="", country="Philippines", access=google_access, base_url=GOOGLE_MAPS_URL):
+    start = time.perf_counter()
+    x = requests.get(f"{base_url}/maps/api/geocode/json?address={address},{prov},{country}&key={access}")
+    x = x.json()
+    record_api_call('google-geocode', time.perf_counter()-start)
+    return parse_geocode(x)
+
+def geocode_concurrent(addresses, prov="", country="Philippines", access=google_access, base_url=GOOGLE_MAPS_URL,
+                       rate=50, per=1.0, n_workers=8, max_retries=5):
+    """
+    Input:
+    - addresses: List of addresses
+    - prov, country, access, base_url: As in `geocode`
+    - rate, per: Request quota, `rate` requests every `per` seconds
+    - n_workers: Number of concurrent requests
+    - max_retries: Retries per request
+    
+    Output:
+    - List of (lon, lat, precision) tuples, in the order of addresses
+    """
+    limiter = make_rate_limiter(rate, per)
+    fetch = lambda address: parse_geocode(request_with_retry(
+        f"{base_url}/maps/api/geocode/json?address={address},{prov},{country}&key={access}", limiter, max_retries,
+        api='google-geocode'))
+    with ThreadPoolExecutor(n_workers) as pool:
+        return list(pool.map(fetch, addresses))
+
+def road_distances(lst, x):
+    """
+    Input:
+    - lst: List of up to 100 (lon, lat) tuples sent to the Roads API
+    - x: JSON response of the nearestRoads request
+    
+    Output:
+    - List of distances in km from each point to its snapped point, None if not snapped
+    """
+    # Format results into dictionary by ID
+    road_lst = [(None,None)]*len(lst)
+    if 'snappedPoints' in x.keys():
+        x = x['snappedPoints']
+        for d in x:
+            road_lst[d['originalIndex']] = (d['location']['longitude'],d['location']['latitude'])
+    
+    # Use haversine formula to find distance between points
+    return [haversine(pt1, pt2) if (pt2[0] and pt2[1]) else None for (pt1, pt2) in zip(lst, road_lst)]
+
+def nearest_road(coords, google_access=google_access, base_url=GOOGLE_ROADS_URL):
     result = []
     for i in range((len(coords)//100)+1):
         # Take 100 coordinates at a time
@@ -31,18 +88,104 @@ def nearest_road(coords, google_access=google_access):
         
         # Turn into string, query it, then obtain points
         query = "|".join([f"{pt[1]},{pt[0]}" for pt in lst])
-        x = requests.get(f"https://roads.googleapis.com/v1/nearestRoads?points={query}&key={google_access}").json()
+        start = time.perf_counter()
+        x = requests.get(f"{base_url}/v1/nearestRoads?points={query}&key={google_access}").json()
+        record_api_call('google-roads', time.perf_counter()-start)
+        result.extend(road_distances(lst, x))
+    return result
+
+def nearest_road_concurrent(coords, google_access=google_access, base_url=GOOGLE_ROADS_URL,
+                            rate=50, per=1.0, n_workers=8, max_retries=5):
+    """
+    Input:
+    - coords: List of shapely coordinates
+    - google_access, base_url: As in `nearest_road`
+    - rate, per: Request quota, `rate` requests every `per` seconds
+    - n_workers: Number of concurrent requests
+    - max_retries: Retries per request
+    
+    Output:
+    - List of distances in km to the nearest road, as from `nearest_road`
+    """
+    limiter = make_rate_limiter(rate, per)
+    points = [(pt.x,pt.y) for pt in coords]
+    chunks = [points[i:i+100] for i in range(0, len(points), 100)]
+    
+    def fetch(lst):
+        query = "|".join([f"{pt[1]},{pt[0]}" for pt in lst])
+        return road_distances(lst, request_with_retry(f"{base_url}/v1/nearestRoads?points={query}&key={google_access}",
+                                                      limiter, max_retries, api='google-roads'))
+    with ThreadPoolExecutor(n_workers) as pool:
+        return list(itertools.chain.from_iterable(pool.map(fetch, chunks)))
+
+def build_road_index(roads):
+    """
+    Input:
+    - roads: List or GeoSeries of road LineStrings (e.g. an OSM roads layer), or a
+             graph dictionary from `load_osm_graph` whose edges are used as segments
+    
+    Output:
+    Dictionary with
+    - lines: Array of road lines, with longitudes scaled by the cosine of the mean
+             latitude so that planar distances approximate ground distances
+    - scale: The longitude scale factor
+    - tree: STRtree over the scaled lines
+    """
+    if isinstance(roads, dict):
+        edges = np.unique(np.sort(roads['edges'], axis=1), axis=0)
+        lines = shapely.linestrings(np.stack([roads['lon'][edges], roads['lat'][edges]], axis=-1))
+    else:
+        lines = np.asarray(roads, dtype=object)
+        lines = lines[~shapely.is_missing(lines) & ~shapely.is_empty(lines)]
+    
+    # Equirectangular projection around the mean latitude of the roads
+    bounds = shapely.total_bounds(lines)
+    scale = np.cos(np.radians((bounds[1]+bounds[3])/2))
+    lines = shapely.transform(lines, lambda xy: xy*[scale, 1])
+    return {'lines': lines, 'scale': scale, 'tree': shapely.STRtree(lines)}
+
+def nearest_road_offline(coords, roads, max_distance=None, batch_size=100000, return_snapped=False):
+    """
+    Input:
+    - coords: List of shapely coordinates (or (lon, lat) tuples)
+    - roads: Road index from `build_road_index`, or anything it accepts
+    - max_distance: Points farther than this many km from every road are not
+                    snapped (None), like points the Roads API cannot snap
+    - batch_size: Number of points queried at a time
+    - return_snapped: Whether to also return the snapped points
+    
+    Output:
+    - result: List of distances in km from each point to the nearest road, None if
+      not snapped, as from `nearest_road`
+    - snapped: List of the nearest points on the roads (shapely points or None),
+      only if return_snapped
+    """
+    # Graph dictionaries also hold a 'tree' (the node KD-tree of `snap_points`)
+    index = roads if isinstance(roads, dict) and 'lines' in roads and 'scale' in roads else build_road_index(roads)
+    if len(coords) and isinstance(coords[0], tuple):
+        lon, lat = point_coords(coords)
+    else:
+        lon, lat = shapely.get_coordinates(np.asarray(coords, dtype=object)).T
+    
+    dist = np.full(len(lon), np.nan)
+    snapped = np.full((len(lon), 2), np.nan)
+    for i in range(0, len(lon), batch_size):
+        points = shapely.points(lon[i:i+batch_size]*index['scale'], lat[i:i+batch_size])
         
-        # Format results into dictionary by ID
-        road_lst = [(None,None)]*len(lst)
-        if 'snappedPoints' in x.keys():
-            x = x['snappedPoints']
-            for d in x:
-                road_lst[d['originalIndex']] = (d['location']['longitude'],d['location']['latitude'])
+        # One nearest line per point, ties broken by the tree order
+        kwargs = {} if max_distance is None else {'max_distance': max_distance/111.32}
+        pt_idx, line_idx = index['tree'].query_nearest(points, all_matches=False, **kwargs)
+        lines = index['lines'][line_idx]
+        nearest = shapely.line_interpolate_point(lines, shapely.line_locate_point(lines, points[pt_idx]))
+        xy = shapely.get_coordinates(nearest)
         
-        # Use haversine formula to find distance between points
-        distances = [haversine(pt1, pt2) if (pt2[0] and pt2[1]) else None for (pt1, pt2) in zip(lst, road_lst)]
-        result.extend(distances)
+        rows = i+pt_idx
+        snapped[rows] = np.column_stack([xy[:,0]/index['scale'], xy[:,1]])
+        dist[rows] = haversine_vectorized(lon[rows], lat[rows], snapped[rows,0], snapped[rows,1])
+    
+    result = [None if np.isnan(d) else float(d) for d in dist]
+    if return_snapped:
+        return result, [None if np.isnan(x) else shapely.Point(x, y) for (x, y) in snapped]
     return result
 
 def subset_hrsl(hrsl, gdf):
@@ -74,20 +217,93 @@ def subset_hrsl(hrsl, gdf):
     subset_hrsl = subset_hrsl.drop('index_right', axis=1)
     return subset_hrsl
 
-def generate_isochrones(gdf, col='geometry'):
+def read_population_raster(raster_path, gdf, band=1, block_rows=1024):
+    """
+    Input:
+    - raster_path: Population GeoTIFF, e.g. data/population_raw/PHL_ppp_v2b_2020_UNadj.tif
+    - gdf: Geodataframe pertaining to area to read, e.g. the merged municipality
+    - band: Raster band holding the population
+    - block_rows: Number of raster rows read at a time
+    
+    Output:
+    - lon, lat, pop: float32 arrays of the populated cells whose centres lie within
+      the area, read only from the raster windows covering each of its polygons
+    """
+    import rasterio
+    from rasterio.windows import Window, from_bounds
+    from rasterio.errors import WindowError
+    
+    with rasterio.open(raster_path) as src:
+        area = gdf.to_crs(src.crs) if (src.crs and gdf.crs and gdf.crs != src.crs) else gdf
+        polygon = shapely.union_all(area['geometry'].values)
+        shapely.prepare(polygon)
+        full = Window(0, 0, src.width, src.height)
+        T = src.transform
+        
+        cells, lon, lat, pop = [], [], [], []
+        for part in shapely.get_parts(polygon):
+            # Smallest whole-pixel window covering the polygon's bounds
+            bounds = from_bounds(*part.bounds, transform=T)
+            col_off, row_off = np.floor(bounds.col_off), np.floor(bounds.row_off)
+            window = Window(col_off, row_off, np.ceil(bounds.col_off+bounds.width)-col_off,
+                            np.ceil(bounds.row_off+bounds.height)-row_off)
+            try:
+                window = window.intersection(full)
+            except WindowError:
+                continue
+            for row_off in range(int(window.row_off), int(window.row_off+window.height), block_rows):
+                block = Window(window.col_off, row_off, window.width, min(block_rows, window.row_off+window.height-row_off))
+                data = src.read(band, window=block, masked=True)
+                rows, cols = np.nonzero(data.filled(0) > 0)
+                
+                # Pixel centres, as in the coordinates of rioxarray
+                rows, cols = rows+int(block.row_off), cols+int(block.col_off)
+                x = T.c + (cols+0.5)*T.a + (rows+0.5)*T.b
+                y = T.f + (cols+0.5)*T.d + (rows+0.5)*T.e
+                inside = shapely.contains_xy(polygon, x, y)
+                cells.append(rows[inside].astype(np.int64)*src.width + cols[inside])
+                lon.append(x[inside]); lat.append(y[inside])
+                pop.append(data.data[rows[inside]-int(block.row_off), cols[inside]-int(block.col_off)])
+    
+    if not cells:
+        return tuple(np.zeros(0, dtype=np.float32) for _ in range(3))
+    
+    # Cells read twice through the overlapping windows of neighbouring polygons are kept once
+    _, first = np.unique(np.concatenate(cells), return_index=True)
+    return tuple(np.concatenate(arr)[first].astype(np.float32) for arr in (lon, lat, pop))
+
+def population_to_hrsl(lon, lat, pop, col='population_2020', crs='EPSG:4326'):
+    """
+    Input:
+    - lon, lat, pop: Arrays from `read_population_raster`
+    - col: Name of the population column
+    
+    Output:
+    - hrsl: HRSL geodataframe as from `subset_hrsl`, with longitude, latitude, col and geometry columns
+    """
+    hrsl = pd.DataFrame({'longitude':lon, 'latitude':lat, col:pop})
+    return gpd.GeoDataFrame(hrsl, geometry=shapely.points(hrsl['longitude'].values, hrsl['latitude'].values), crs=crs)
+
+def generate_isochrones(gdf, col='geometry', graph=None, **kwargs):
     """
     Input: 
     - gdf: Dataframe with a column named `col` corresponding to coordinates of points
+    - graph: Road graph from `load_osm_graph`; if given, the isochrones are built 
+             locally with `local_isochrones` (keyword arguments are passed on) 
+             instead of calling the Mapbox API
     
     Output: 
     - gdf30: Geodataframe with 30 minute isochrones as its `geometry` column
     - gdf60: Geodataframe with 60 minute isochrones as its `geometry` column
     """
-    isochrones = [isochrone(p.x,p.y) for p in gdf[col]]
+    if graph is not None:
+        isochrones = local_isochrones(graph, gdf[col], minutes=(30, 60), **kwargs)
+    else:
+        isochrones = [isochrone(p.x,p.y) for p in gdf[col]]
     gdf['i30'] = [item[0] for item in isochrones]
     gdf['i60'] = [item[1] for item in isochrones]
 
     gdf30 = gpd.GeoDataFrame(gdf, geometry=gdf['i30'])
     gdf60 = gpd.GeoDataFrame(gdf, geometry=gdf['i60'])
     
-    return gdf30, gdf60
\ No newline at end of file
+    return gdf30, gdf60
@@ -0,0 +1,107 @@
+import os
+import pandas as pd
+import shapely
+import numpy as np
+import geopandas as gpd
+
+WKT_TYPES = ('POINT', 'LINESTRING', 'POLYGON', 'MULTIPOINT', 'MULTILINESTRING',
+             'MULTIPOLYGON', 'GEOMETRYCOLLECTION')
+
+def _is_stale(cache_path, csv_path):
+    """
+    True if the binary copy does not exist yet or is older than the CSV
+    """
+    return not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(csv_path)
+
+def wkt_columns(df):
+    """
+    Input:
+    - df: Dataframe read from a CSV
+
+    Output:
+    - List of columns whose first non-null value is WKT text
+    """
+    cols = []
+    for col in df.columns:
+        values = df[col].dropna()
+        if len(values) and isinstance(values.iloc[0], str) and values.iloc[0].upper().startswith(WKT_TYPES):
+            cols.append(col)
+    return cols
+
+def csv_to_gdf(csv_path, geometry='geometry', crs='EPSG:4326', geometry_cols=None):
+    """
+    Input:
+    - csv_path: CSV with geometries stored as WKT text
+    - geometry: Column to use as the active geometry
+    - crs: Coordinate reference system of the geometries
+    - geometry_cols: WKT columns to parse, detected from the values if None
+
+    Output:
+    - Geodataframe with every WKT column parsed in one vectorized call per column
+    """
+    df = pd.read_csv(csv_path)
+    geometry_cols = geometry_cols if geometry_cols else wkt_columns(df)
+    for col in geometry_cols:
+        df[col] = gpd.GeoSeries(shapely.from_wkt(df[col].where(df[col].notna(), None).values), crs=crs)
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
+
+def load_gdf(csv_path, geometry='geometry', crs='EPSG:4326', geometry_cols=None, fmt='parquet'):
+    """
+    Input:
+    - csv_path: CSV with geometries stored as WKT text, e.g. data/sites_antipolo.csv
+    - geometry, crs, geometry_cols: As in `csv_to_gdf`
+    - fmt: 'parquet' (GeoParquet) or 'feather'
+
+    Output:
+    - Geodataframe read from the binary copy next to the CSV, where geometries are
+      stored as WKB; the copy is (re)written from the CSV when missing or older
+    """
+    cache_path = f"{os.path.splitext(csv_path)[0]}.{fmt}"
+    if _is_stale(cache_path, csv_path):
+        gdf = csv_to_gdf(csv_path, geometry, crs, geometry_cols)
+        gdf.to_parquet(cache_path) if fmt=='parquet' else gdf.to_feather(cache_path)
+    return gpd.read_parquet(cache_path) if fmt=='parquet' else gpd.read_feather(cache_path)
+
+def load_matrix(csv_path, dtype='float64', mmap=True):
+    """
+    Input:
+    - csv_path: CSV of a matrix with a header row, e.g. data/time_matrix_antipolo.csv
+    - dtype: 'float64', or 'float32' to halve the size
+    - mmap: Whether to memory map the array (read-only, shared between processes)
+            instead of reading it into memory
+
+    Output:
+    - Array read from the .npy copy next to the CSV; the copy is (re)written
+      from the CSV when missing or older
+    """
+    stem = os.path.splitext(csv_path)[0]
+    cache_path = f"{stem}.npy" if np.dtype(dtype)==np.float64 else f"{stem}_{np.dtype(dtype).name}.npy"
+    if _is_stale(cache_path, csv_path):
+        np.save(cache_path, pd.read_csv(csv_path).values.astype(dtype))
+    return np.load(cache_path, mmap_mode='r' if mmap else None)
+
+def load_run_data(name, root='data', dtype='float64', mmap=True, crs='EPSG:4326'):
+    """
+    Input:
+    - name: Lowercase LGU name used in the file names, e.g. 'antipolo'
+    - root: Data folder
+    - dtype, mmap: As in `load_matrix`
+    - crs: Coordinate reference system of the geometries
+
+    Output:
+    Dictionary with whichever of the notebook's inputs exist under root:
+    - all_sites: Geodataframe of candidate sites (all_sites_<name>.csv)
+    - sites: Geodataframe of sites with isochrones (sites_<name>.csv)
+    - time_matrix: HRSL x sites drive time matrix (time_matrix_<name>.csv)
+    - time_matrix_rhu: HRSL x RHU drive time matrix (time_matrix_<name>_rhu.csv)
+    """
+    result = {}
+    paths = {'all_sites': f"{root}/all_sites_{name}.csv", 'sites': f"{root}/sites_{name}.csv"}
+    for (key, path) in paths.items():
+        if os.path.exists(path):
+            result[key] = load_gdf(path, crs=crs)
+    paths = {'time_matrix': f"{root}/time_matrix_{name}.csv", 'time_matrix_rhu': f"{root}/time_matrix_{name}_rhu.csv"}
+    for (key, path) in paths.items():
+        if os.path.exists(path):
+            result[key] = load_matrix(path, dtype, mmap)
+    return result
@@ -2,28 +2,71 @@ import pandas as pd
 import shapely
 import numpy as np
 import itertools
+import scipy.sparse
 
 import random
 
+from helper_functions.instrumentation_helper import stage_span, instrumented_stage
+
+def point_isochrone_incidence(points, isochrones):
+    """
+    Input:
+    - points: Array of shapely points
+    - isochrones: Array of shapely polygons
+    
+    Output:
+    - n_points x n_isochrones sparse boolean matrix, True where the 
+      isochrone contains the point, built from one STRtree query
+    """
+    tree = shapely.STRtree(isochrones)
+    point_idx, iso_idx = tree.query(points, predicate='within')
+    return scipy.sparse.csr_matrix((np.ones(len(point_idx), dtype=bool), (point_idx, iso_idx)),
+                                   shape=(len(points), len(isochrones)))
+
+@instrumented_stage()
 def compute_expected_demand(hrsl, hosp, union, pop_col='population_2020'):
+    """
+    Input:
+    - hrsl: Geodataframe of HRSL points with population column `pop_col`
+    - hosp: Geodataframe of hospital isochrones with a 'capacity' column
+    - union: Union of the hospital isochrones
+    - pop_col: Population column of hrsl
     
+    Output:
+    - hrsl: HRSL geodataframe with the population left unserved by the hospitals;
+      hosp['capacity'] is reduced to the remaining capacity
+    
+    Note:
+    HRSL points are visited in random order; each one draws on the hospitals
+    whose isochrone contains it, in proportion to their remaining capacity
+    """
     # Subset the dataframe to HRSL populations (1) with people and (2) within 30 minutes of a facility
-    temp_hrsl = hrsl.loc[hrsl[pop_col]>0]
-    covered_idx = [i for i,geom in enumerate(temp_hrsl['geometry']) if geom.within(union)]
-    temp_hrsl = temp_hrsl.loc[covered_idx]
+    shapely.prepare(union)
+    populated = hrsl[pop_col].values > 0
+    covered = populated & shapely.contains(union, hrsl['geometry'].values)
+    covered_idx = list(hrsl.index[covered])
     
-    # Iterate randomly through the rows and reduce capacity at each iteration
-    for i, row in temp_hrsl.loc[random.sample(list(temp_hrsl.index), temp_hrsl.shape[0])].iterrows():
+    # Iterate randomly through the points, precomputing the hospitals within 30 mins of each
+    order = random.sample(covered_idx, len(covered_idx))
+    positions = hrsl.index.get_indexer(order)
+    incidence = point_isochrone_incidence(hrsl['geometry'].values[positions], hosp['geometry'].values)
+    population = hrsl[pop_col].values[positions].astype(float)
+    capacity = hosp['capacity'].values.astype(float)
     
-        # Get all the hospitals which are within 30 mins of the HRSL point
-        temp = hosp.loc[hosp.geometry.apply(lambda x: x.contains(row['geometry']))]
-
-        # If the HRSL's population can be completely serviced, set to 0
-        if sum(temp['capacity']) >= row[pop_col]:
-            hosp.loc[temp.index,'capacity'] = temp['capacity']-(row[pop_col]*temp['capacity']/sum(temp['capacity']))
-            hrsl.loc[i,pop_col] = 0
-        # If not, subtract only the serviceable population
-        else:
-            hrsl.loc[i,pop_col] -= sum(temp['capacity'])
-            hosp.loc[temp.index,'capacity'] = 0
-    return hrsl
\ No newline at end of file
+    with stage_span('allocate_capacity', total=len(order)) as span:
+        for i in span.track(range(len(order))):
+            idx = incidence.indices[incidence.indptr[i]:incidence.indptr[i+1]]
+            total = capacity[idx].sum()
+        
+            # If the HRSL's population can be completely serviced, set to 0
+            if total >= population[i]:
+                capacity[idx] -= population[i]*capacity[idx]/total
+                population[i] = 0
+            # If not, subtract only the serviceable population
+            else:
+                population[i] -= total
+                capacity[idx] = 0
+    
+    hrsl.loc[order, pop_col] = population
+    hosp['capacity'] = capacity
+    return hrsl
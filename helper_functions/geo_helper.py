@@ -0,0 +1,66 @@
+import numpy as np
+from math import radians, cos, sin, asin, sqrt
+
+def haversine(pt1, pt2):
+    """
+    Calculate the great circle distance between two points 
+    on the earth (specified in decimal degrees)
+    """
+    if 'tuple' in str(type(pt1)).lower():
+        lon1, lat1 = pt1
+        lon2, lat2 = pt2
+    else:
+        lon1, lat1 = pt1.x, pt1.y
+        lon2, lat2 = pt2.x, pt2.y
+
+    # convert decimal degrees to radians 
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+
+    # haversine formula 
+    dlon = lon2 - lon1 
+    dlat = lat2 - lat1 
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a)) 
+    r = 6371 # Radius of earth in kilometers. Use 3956 for miles
+    return c * r
+
+def haversine_vectorized(lon1, lat1, lon2, lat2):
+    """
+    Vectorized `haversine` over arrays of coordinates (in decimal degrees),
+    returning distances in kilometers
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2-lon1)/2)**2
+    return 2 * np.arcsin(np.sqrt(a)) * 6371
+
+def lonlat_to_xyz(lon, lat):
+    """
+    Converts arrays of coordinates (in decimal degrees) to points on the unit sphere,
+    where straight-line (chord) distances preserve the ordering of haversine distances
+    """
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+def km_to_chord(km):
+    """
+    Converts a great circle distance in kilometers to a chord length on the unit sphere
+    """
+    return 2*np.sin(np.minimum(np.asarray(km, dtype=float)/6371, np.pi)/2)
+
+def chord_to_km(chord):
+    """
+    Converts a chord length on the unit sphere to a great circle distance in kilometers
+    """
+    return 2*np.arcsin(np.minimum(np.asarray(chord, dtype=float)/2, 1))*6371
+
+def point_coords(points):
+    """
+    Input:
+    - points: List of shapely points or (lon, lat) tuples
+    
+    Output:
+    - lon, lat: Arrays of coordinates
+    """
+    coords = np.array([(pt[0], pt[1]) if 'tuple' in str(type(pt)).lower() else (pt.x, pt.y) 
+                       for pt in points], dtype=float).reshape(-1, 2)
+    return coords[:,0], coords[:,1]
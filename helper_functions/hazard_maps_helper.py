@@ -6,7 +6,8 @@ import tifffile as tiff
 import matplotlib.pyplot as plt
 import shapely
 import geopandas as gpd
-from helper_functions.mapbox_helper import haversine
+from scipy.spatial import cKDTree
+from helper_functions.geo_helper import lonlat_to_xyz, chord_to_km, point_coords
 import pickle
 
 colors = {
@@ -104,6 +105,75 @@ def produce_hazard_coords_by_hazard(folder, top, bottom, left, right):
                                    indiv=True)
     return hazard_coords, filenames
 
+def png_shape(filename):
+    """
+    Returns the (height, width) of a PNG from its IHDR header, without decoding the image
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(24)
+    return int.from_bytes(header[20:24], 'big'), int.from_bytes(header[16:20], 'big')
+
+def _pixel_coords(rows, cols, lon, lat, values):
+    return pd.DataFrame({'longitude':lon[cols], 'latitude':lat[rows], 'mask':values})
+
+def stream_hazard_coords(folder, top, bottom, left, right, indiv=False, tile_rows=512,
+                         hazard_legend=hazard_legend, colors=colors):
+    """
+    Inputs:
+    - folder: Folder of hazard map PNGs, as for `produce_hazard_coords`
+    - top, bottom, left, right: Bounds of the maps in decimal degrees
+    - indiv: Whether to return the hazard pixels per map instead of combined
+    - tile_rows: Number of image rows masked at a time
+    
+    Outputs:
+    - Same as `produce_hazard_coords` (indiv=False) or `produce_hazard_coords_by_hazard` 
+      (indiv=True), computed one image and one tile of rows at a time
+    
+    Note:
+    The padded size is read from the PNG headers, so only one image is held in memory;
+    pixel coordinates are only looked up for the pixels above the threshold, and the
+    combined mask is a single uint8 array summed the same way as `find_hazard_coords`
+    """
+    filenames = [f"{folder}/{item}" for item in os.listdir(folder) if '.png' in item]
+    shapes = np.array([png_shape(name) for name in filenames]).reshape(-1, 2)
+    height, width = np.max(shapes, axis=0) if len(shapes) else (0, 0)
+    lon = np.linspace(left, right, width)
+    lat = np.linspace(bottom, top, height)
+    
+    mask = np.zeros((height, width), dtype=np.uint8) if not indiv else None
+    result = []
+    for name in filenames:
+        hazard = next((hazard for hazard in hazard_legend.keys() if hazard in name), None)
+        if hazard is None:
+            continue
+        img = cv2.imread(name)
+        # Mask value of the black padding added by `pad_folder_images`
+        pad_value = mask_hazard(np.zeros((1, 1, 3), dtype=np.uint8), hazard_legend[hazard], colors)[0, 0]
+        
+        frames = []
+        for start in range(0, height, tile_rows):
+            tile = np.full((min(tile_rows, height-start), width), pad_value, dtype=np.uint8)
+            if start < img.shape[0]:
+                tile_img = img[start:start+tile_rows]
+                tile[:tile_img.shape[0], :tile_img.shape[1]] = mask_hazard(tile_img, hazard_legend[hazard], colors)
+            if indiv:
+                rows, cols = np.nonzero(tile > 250)
+                frames.append(_pixel_coords(rows+start, cols, lon, lat, tile[rows, cols]))
+            else:
+                mask[start:start+len(tile)] += tile
+        if indiv:
+            result.append(pd.concat(frames, ignore_index=True) if frames else _pixel_coords([], [], lon, lat, np.zeros(0, dtype=np.uint8)))
+        del img
+    
+    if indiv:
+        return result, filenames
+    frames = []
+    for start in range(0, height, tile_rows):
+        tile = mask[start:start+tile_rows]
+        rows, cols = np.nonzero(tile > 250)
+        frames.append(_pixel_coords(rows+start, cols, lon, lat, tile[rows, cols]))
+    return pd.concat(frames, ignore_index=True) if frames else _pixel_coords([], [], lon, lat, np.zeros(0, dtype=np.uint8))
+
 def subset_hazards(df_hazards, mun):
     """
     Inputs:
@@ -132,18 +202,72 @@ def select_good_sites(all_sites, df_hazards, km=1):
     site_coords = np.array([[pt.x,pt.y] for pt in all_sites['geometry']])
     hazard_coords = np.array([[x,y] for (x,y) in zip(df_hazards['longitude'],df_hazards['latitude'])])
 
-    # Identify all coordinates at least 1km from a hazard point
-    good_sites = []
-    for i, site in enumerate(site_coords):
-        min_manhattan = np.min(np.sum(np.abs(hazard_coords-site), axis=1))
-        if min_manhattan >= (KM_TO_DEGREES*km):
-            good_sites.append(i)
+    # Identify all coordinates at least 1km from a hazard point (nearest Manhattan distance from a KD-tree)
+    min_manhattan, _ = cKDTree(hazard_coords).query(site_coords, p=1)
+    good_sites = list(np.flatnonzero(min_manhattan >= (KM_TO_DEGREES*km)))
 
     # Keep only the good sites
     all_sites = all_sites.loc[all_sites['index'].isin(good_sites)]
     
     return all_sites
 
+def build_hazard_index(hazard_coords, filenames=None):
+    """
+    Inputs:
+    - hazard_coords: Dataframe, or list of dataframes (one per hazard layer, as from
+                     `produce_hazard_coords_by_hazard`), with 'longitude' and 'latitude' columns
+    - filenames: Names of the hazard layers, defaults to their positions
+    
+    Outputs:
+    - index: Dictionary of layer name to a KD-tree over the hazard pixels on the unit sphere,
+             or None for a layer without hazard pixels
+    """
+    if isinstance(hazard_coords, pd.DataFrame):
+        hazard_coords = [hazard_coords]
+    filenames = filenames if filenames is not None else list(range(len(hazard_coords)))
+    index = {}
+    for (name, hazard_df) in zip(filenames, hazard_coords):
+        xyz = lonlat_to_xyz(hazard_df['longitude'].values, hazard_df['latitude'].values)
+        index[name] = cKDTree(xyz, balanced_tree=False) if len(xyz) else None
+    return index
+
+def hazard_distances(index, coord_lst):
+    """
+    Inputs:
+    - index: Dictionary from `build_hazard_index`
+    - coord_lst: List of shapely coordinates (or (lon, lat) tuples) of the sites
+    
+    Outputs:
+    - Dictionary of layer name to an array of the distance in km from each site to 
+      the nearest hazard pixel of the layer (infinity for an empty layer)
+    """
+    xyz = lonlat_to_xyz(*point_coords(coord_lst))
+    result = {}
+    for (name, tree) in index.items():
+        if tree is None:
+            result[name] = np.full(len(xyz), np.inf)
+        else:
+            chord, _ = tree.query(xyz)
+            result[name] = chord_to_km(chord)
+    return result
+
+def select_good_sites_km(all_sites, df_hazards, km=1, index=None):
+    """
+    Inputs:
+    - all_sites: Geodataframe of candidate sites with a 'geometry' column
+    - df_hazards: Dataframe of hazard sites with 'longitude' and 'latitude' columns, or a list
+                  of such dataframes; ignored if index is given
+    - km: Minimum distance in km from every hazard pixel
+    - index: Dictionary from `build_hazard_index`, built from df_hazards if None
+    
+    Outputs:
+    - all_sites: The sites at least km kilometres (great circle) from every hazard pixel
+    """
+    index = index if index is not None else build_hazard_index(df_hazards)
+    distances = hazard_distances(index, all_sites['geometry'])
+    min_dist = np.min(np.vstack(list(distances.values())), axis=0) if distances else np.full(len(all_sites), np.inf)
+    return all_sites.loc[min_dist >= km]
+
 # Hazard Mapping Functions
 def open_pkl(file):
     with (open(file,"rb")) as openfile:
@@ -155,11 +279,17 @@ def to_gdf(df):
     return df
 
 # Identify distance to hazard per site
-def return_closest_hazards(coord_lst, hazard_coords, filenames):
-    result = []
-    for i, hazard_df in enumerate(hazard_coords):
-        min_dist = []
-        for site in coord_lst:
-            min_dist.append(min(hazard_df['geometry'].apply(lambda x: haversine(site, x))))
-        result.append((filenames[i], min_dist))
-    return result
+def return_closest_hazards(coord_lst, hazard_coords, filenames, index=None):
+    """
+    Inputs:
+    - coord_lst: List of shapely coordinates of the sites
+    - hazard_coords: List of hazard dataframes, one per file in filenames
+    - filenames: Names of the hazard layers
+    - index: Dictionary from `build_hazard_index`, built from hazard_coords if None
+    
+    Outputs:
+    - List of (filename, list of distances in km from each site to the nearest hazard pixel)
+    """
+    index = index if index is not None else build_hazard_index(hazard_coords, filenames)
+    distances = hazard_distances(index, coord_lst)
+    return [(name, list(distances[name])) for name in filenames]
@@ -4,12 +4,15 @@ import numpy as np
 import geopandas as gpd
 import requests
 import itertools
+import scipy.sparse
 
 import matplotlib
 import matplotlib.pyplot as plt
 
 import random
 
+from helper_functions.instrumentation_helper import stage_span
+
 def make_site_hrsl_dict(sites, hrsl, pop_col='population_2020'):
     """
     Inputs:
@@ -59,14 +62,16 @@ def make_site_set_hrsl_dict(site_hrsl_dict,
                         (3) hrsl_ids: corresponding HRSL IDs
     """
     site_set_hrsl_dict = {}
-    for i, row in site_sets.iterrows():
-        compiled_HRSL = [site_hrsl_dict[k] for k in row[site_col]]
-        compiled_HRSL = set(list(itertools.chain.from_iterable(compiled_HRSL)))
-        compiled_idx = [item[0] for item in compiled_HRSL]
-        compiled_pop = [item[1] for item in compiled_HRSL]
-        site_set_hrsl_dict[row[id_col]] = {'site_ids': row[site_col],
-                                           'population': compiled_pop,
-                                           'hrsl_ids': compiled_idx}
+    with stage_span('make_site_set_hrsl_dict', total=len(site_sets)) as span:
+        for i, row in site_sets.iterrows():
+            compiled_HRSL = [site_hrsl_dict[k] for k in row[site_col]]
+            compiled_HRSL = set(list(itertools.chain.from_iterable(compiled_HRSL)))
+            compiled_idx = [item[0] for item in compiled_HRSL]
+            compiled_pop = [item[1] for item in compiled_HRSL]
+            site_set_hrsl_dict[row[id_col]] = {'site_ids': row[site_col],
+                                               'population': compiled_pop,
+                                               'hrsl_ids': compiled_idx}
+            span.advance()
     return site_set_hrsl_dict
 
 def add_coords(site_set_hrsl, site_coords):
@@ -80,3 +85,96 @@ def add_coords(site_set_hrsl, site_coords):
         site_set_hrsl[key]['coords'] = [site_coords[idx] for idx in site_set_hrsl[key]['site_ids']]
     return site_set_hrsl
 
+def make_site_hrsl_matrix(site_hrsl_dict, n_sites=None):
+    """
+    Inputs:
+    - site_hrsl_dict: Dictionary with site index as key,
+                      and list of tuples (hrsl_idx, population) 
+                      as value
+    - n_sites: Number of sites (rows), defaults to the largest site index + 1
+    
+    Output:
+    - coverage: n_sites x n_HRSL CSR matrix, 1 where the site's isochrone
+                contains the HRSL point
+    - hrsl_pop: Array of populations per HRSL column, NaNs set to 0
+    - hrsl_ids: Array of HRSL indices per HRSL column
+    """
+    keys = np.array([key for (key,value) in site_hrsl_dict.items() for _ in value], dtype=int)
+    pairs = np.array([pair for value in site_hrsl_dict.values() for pair in value], dtype=float).reshape(-1, 2)
+    
+    # Drop sites without any HRSL point (NaN index from the left join)
+    valid = ~np.isnan(pairs[:,0])
+    keys, pairs = keys[valid], pairs[valid]
+    hrsl_ids, cols = np.unique(pairs[:,0].astype(int), return_inverse=True)
+    hrsl_pop = np.zeros(len(hrsl_ids))
+    hrsl_pop[cols] = np.nan_to_num(pairs[:,1])
+    
+    n_sites = n_sites if n_sites else max(site_hrsl_dict.keys())+1
+    coverage = scipy.sparse.csr_matrix((np.ones(len(keys), dtype=np.int8), (keys, cols)),
+                                       shape=(n_sites, len(hrsl_ids)))
+    coverage.sum_duplicates()
+    coverage.data[:] = 1
+    return coverage, hrsl_pop, hrsl_ids
+
+def site_sets_to_array(site_sets, site_col='site_set'):
+    """
+    Inputs:
+    - site_sets: Dataframe with column with list of sets <site_col>, as from `sample_sets`
+    - site_col: Column name of site_sets for sites
+    
+    Output:
+    n_sets x set_size integer array of site ids
+    """
+    return np.array(list(site_sets[site_col]), dtype=int)
+
+def score_site_sets(coverage, hrsl_pop, site_set_array, chunk_size=10000):
+    """
+    Inputs:
+    - coverage: n_sites x n_HRSL CSR matrix from `make_site_hrsl_matrix`
+    - hrsl_pop: Array of populations per HRSL column from `make_site_hrsl_matrix`
+    - site_set_array: n_sets x set_size integer array of site ids
+    - chunk_size: Number of sets scored per sparse product, bounds memory use
+    
+    Output:
+    Array of the total covered population per set, equal to
+    `compute_metric_population_single` of the set's dictionary
+    """
+    site_set_array = np.asarray(site_set_array, dtype=int)
+    n_sets, set_size = site_set_array.shape
+    scores = np.zeros(n_sets)
+    for start in range(0, n_sets, chunk_size):
+        block = site_set_array[start:start+chunk_size]
+        
+        # Set x site indicator times site x HRSL coverage = set x HRSL counts
+        rows = np.repeat(np.arange(len(block)), set_size)
+        indicator = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows, block.flatten())),
+                                            shape=(len(block), coverage.shape[0]))
+        covered = indicator @ coverage
+        covered.data[:] = 1
+        scores[start:start+chunk_size] = covered @ hrsl_pop
+    return scores
+
+def best_site_sets(site_hrsl_dict, site_set_array, n_best=1, site_coords=None, chunk_size=10000):
+    """
+    Inputs:
+    - site_hrsl_dict: Dictionary with site index as key,
+                      and list of tuples (hrsl_idx, population) 
+                      as value
+    - site_set_array: n_sets x set_size integer array of site ids
+    - n_best: Number of highest scoring sets to return
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - chunk_size: Number of sets scored per sparse product
+    
+    Output:
+    List of n_best tuples (site_set_dict, score), highest score first, in the same
+    form as `mapreduce`; dictionaries are only built for these sets
+    """
+    coverage, hrsl_pop, _ = make_site_hrsl_matrix(site_hrsl_dict)
+    scores = score_site_sets(coverage, hrsl_pop, site_set_array, chunk_size)
+    best = np.argsort(-scores, kind='stable')[:n_best]
+    
+    winners = pd.DataFrame({'set_id': best, 'site_set': [[int(x) for x in site_set_array[i]] for i in best]})
+    site_set_hrsl = make_site_set_hrsl_dict(site_hrsl_dict, winners)
+    if site_coords:
+        site_set_hrsl = add_coords(site_set_hrsl, site_coords)
+    return [(site_set_hrsl[i], scores[i]) for i in best]
@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+# Instrumentation is off until `enable_instrumentation`; while off, `stage_span` returns
+# a shared no-op span and `instrumented_stage` calls straight through
+_state = {'enabled': False, 'log': None, 'trace_path': None, 'progress_every': 10.0, 'sampler': None}
+_events = []
+_open_spans = []
+_stage_totals = {}
+_api_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+def current_rss():
+    """
+    Returns the resident memory of this process in bytes, from /proc where available,
+    otherwise the peak resident memory reported by `resource`
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak*1024
+    except ImportError:
+        return None
+
+def _emit(event):
+    event['time'] = time.time()
+    with _lock:
+        _events.append(event)
+        if _state['log'] is not None:
+            _state['log'].write(json.dumps(event) + "\n")
+            _state['log'].flush()
+
+def _sample_memory(interval, stop):
+    while not stop.wait(interval):
+        rss = current_rss()
+        with _lock:
+            for s in _open_spans:
+                s.peak_rss = max(s.peak_rss or 0, rss or 0)
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def advance(self, n=1):
+        pass
+    def track(self, iterable, weight=None):
+        return iterable
+    def record(self, **fields):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, name, total=None, fields=None):
+        self.name, self.total, self.fields = name, total, fields or {}
+        self.done, self.peak_rss = 0, None
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        stack.append(self)
+        self.start_rss = current_rss()
+        self.peak_rss = self.start_rss
+        with _lock:
+            _open_spans.append(self)
+        self.start = self.last_report = time.perf_counter()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter()-self.start
+        # Spans held open by generators may close out of order
+        _local.stack.remove(self)
+        with _lock:
+            _open_spans.remove(self)
+        end_rss = current_rss()
+        event = {'type': 'span', 'name': self.name, 'parent': self.parent, 'depth': self.depth,
+                 'thread': threading.get_ident(), 'start': self.wall_start, 'duration': duration,
+                 'items': self.done, 'items_per_second': self.done/duration if duration > 0 else None,
+                 'rss_start': self.start_rss, 'rss_end': end_rss,
+                 'rss_peak': max(self.peak_rss or 0, end_rss or 0) or None,
+                 'error': exc_type.__name__ if exc_type else None, **self.fields}
+        with _lock:
+            totals = _stage_totals.setdefault(self.name, {'calls': 0, 'seconds': 0.0, 'items': 0, 'rss_peak': 0})
+            totals['calls'] += 1
+            totals['seconds'] += duration
+            totals['items'] += self.done
+            totals['rss_peak'] = max(totals['rss_peak'], event['rss_peak'] or 0)
+        _emit(event)
+        return False
+
+    def advance(self, n=1):
+        """
+        Counts n more items done, and reports progress with the rate and
+        ETA at most every `progress_every` seconds
+        """
+        self.done += n
+        now = time.perf_counter()
+        if now-self.last_report < _state['progress_every']:
+            return
+        self.last_report = now
+        rate = self.done/(now-self.start)
+        eta = (self.total-self.done)/rate if self.total and rate > 0 else None
+        _emit({'type': 'progress', 'name': self.name, 'done': self.done, 'total': self.total,
+               'elapsed': now-self.start, 'items_per_second': rate, 'eta_seconds': eta})
+
+    def track(self, iterable, weight=None):
+        """
+        Yields the items of iterable, advancing by `weight(item)` (default 1) after each
+        """
+        for item in iterable:
+            yield item
+            self.advance(1 if weight is None else weight(item))
+
+    def record(self, **fields):
+        """
+        Adds values (e.g. acceptance statistics) to the span's event
+        """
+        self.fields.update(fields)
+
+def stage_span(name, total=None, **fields):
+    """
+    Input:
+    - name: Stage name
+    - total: Number of items the stage will process, for the ETA
+    - fields: Extra values recorded with the span
+
+    Output:
+    - Context manager timing the stage; call `.advance(n)` on it as items complete,
+      or wrap the stage's loop in `.track(iterable)`, and `.record(**fields)` to add
+      results to its event
+    """
+    if not _state['enabled']:
+        return _NULL_SPAN
+    return _Span(name, total, fields)
+
+def instrumented_stage(name=None, items=None):
+    """
+    Input:
+    - name: Stage name, defaults to the function name
+    - items: Function of the call's arguments returning the number of items processed,
+             for the items per second of stages without their own `advance` calls
+
+    Output:
+    - Decorator recording every call of the function as a span
+    """
+    def decorator(fn):
+        stage = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return fn(*args, **kwargs)
+            with _Span(stage) as s:
+                result = fn(*args, **kwargs)
+                if items is not None and s.done == 0:
+                    s.done = items(*args, **kwargs)
+                return result
+        return wrapper
+    return decorator
+
+def _api_entry(api):
+    return _api_totals.setdefault(api, {'calls': 0, 'failures': 0, 'retries': 0, 'seconds': 0.0,
+                                        'max_seconds': 0.0, 'cache_hits': 0, 'cache_misses': 0})
+
+def record_api_call(api, latency, retries=0, failed=False):
+    """
+    Input:
+    - api: Name of the API, e.g. 'mapbox-matrix'
+    - latency: Seconds the call took, including retries
+    - retries: Number of retries made
+    - failed: Whether no response was obtained
+    """
+    if not _state['enabled']:
+        return
+    with _lock:
+        totals = _api_entry(api)
+        totals['calls'] += 1
+        totals['failures'] += int(failed)
+        totals['retries'] += retries
+        totals['seconds'] += latency
+        totals['max_seconds'] = max(totals['max_seconds'], latency)
+    _emit({'type': 'api', 'api': api, 'latency': latency, 'retries': retries, 'failed': failed})
+
+def record_cache_lookup(api, hits=0, misses=0):
+    """
+    Input:
+    - api: Name of the API whose responses are cached
+    - hits, misses: Number of cache hits and misses
+    """
+    if not _state['enabled']:
+        return
+    with _lock:
+        totals = _api_entry(api)
+        totals['cache_hits'] += hits
+        totals['cache_misses'] += misses
+
+def instrumentation_summary():
+    """
+    Output:
+    - Dictionary with per stage the calls, total seconds, items, items per second
+      and peak resident memory, and per API the calls, latency, retries, failures
+      and cache hits recorded since `enable_instrumentation`
+    """
+    with _lock:
+        stages = {name: {**totals, 'items_per_second': totals['items']/totals['seconds'] if totals['seconds'] > 0 else None}
+                  for (name, totals) in _stage_totals.items()}
+        apis = {api: {**totals, 'mean_seconds': totals['seconds']/totals['calls'] if totals['calls'] else None}
+                for (api, totals) in _api_totals.items()}
+    return {'stages': stages, 'apis': apis}
+
+def export_trace(path):
+    """
+    Writes the recorded spans in the Chrome trace event format, viewable in
+    chrome://tracing or Perfetto
+    """
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    trace = [{'name': e['name'], 'ph': 'X', 'ts': e['start']*1e6, 'dur': e['duration']*1e6, 'pid': pid,
+              'tid': e['thread'], 'args': {k: v for (k, v) in e.items() if k not in ('name', 'start', 'duration', 'thread')}}
+             for e in events if e['type'] == 'span']
+    trace += [{'name': e['api'], 'ph': 'i', 's': 'p', 'ts': e['time']*1e6, 'pid': pid, 'tid': 0,
+               'args': {'latency': e['latency'], 'retries': e['retries'], 'failed': e['failed']}}
+              for e in events if e['type'] == 'api']
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+def enable_instrumentation(log_path=None, trace_path=None, progress_every=10.0, memory_interval=0.5):
+    """
+    Input:
+    - log_path: File the events are appended to as JSON lines, or None for stderr
+    - trace_path: File `disable_instrumentation` writes a Chrome trace to, optional
+    - progress_every: Minimum seconds between progress events of a span
+    - memory_interval: Seconds between resident memory samples, None to only sample
+                       at the start and end of spans
+    """
+    disable_instrumentation()
+    with _lock:
+        _events.clear()
+        _stage_totals.clear()
+        _api_totals.clear()
+    _state['log'] = open(log_path, 'a') if log_path else sys.stderr
+    _state['trace_path'] = trace_path
+    _state['progress_every'] = progress_every
+    if memory_interval:
+        stop = threading.Event()
+        thread = threading.Thread(target=_sample_memory, args=(memory_interval, stop), daemon=True)
+        thread.start()
+        _state['sampler'] = (thread, stop)
+    _state['enabled'] = True
+
+def disable_instrumentation():
+    """
+    Stops recording, writes the trace file if one was given, and closes the log;
+    the recorded events stay available to `instrumentation_summary` and `export_trace`
+    """
+    if not _state['enabled']:
+        return
+    _state['enabled'] = False
+    if _state['sampler']:
+        thread, stop = _state['sampler']
+        stop.set()
+        thread.join()
+        _state['sampler'] = None
+    if _state['trace_path']:
+        export_trace(_state['trace_path'])
+    if _state['log'] not in (None, sys.stderr):
+        _state['log'].close()
+    _state['log'] = None
@@ -4,20 +4,32 @@ import numpy as np
 import geopandas as gpd
 import requests
 import itertools
-from math import radians, cos, sin, asin, sqrt
 
 import matplotlib
 import matplotlib.pyplot as plt
 import time
 import random
+import os
 
-print("MapBox Access: ")
-access = input()
+from helper_functions.geo_helper import (haversine, haversine_vectorized, lonlat_to_xyz, km_to_chord,
+                                         chord_to_km, point_coords)
+from helper_functions.instrumentation_helper import record_api_call
+
+# Base URL of the API, can point to a local server for testing
+MAPBOX_URL = "https://api.mapbox.com"
+
+# Read the access token from the environment if set, otherwise ask for it
+access = os.environ.get("MAPBOX_ACCESS_TOKEN")
+if not access:
+    print("MapBox Access: ")
+    access = input()
 
 # Generate isochrone using Mapbox API
-def isochrone(lon,lat,access=access):
-    r = requests.get(f"https://api.mapbox.com/isochrone/v1/mapbox/walking/{lon},{lat}?contours_minutes=30,60&contours_colors=6706ce,04e813&polygons=true&access_token={access}")
+def isochrone(lon,lat,access=access,base_url=MAPBOX_URL,profile='walking'):
+    start = time.perf_counter()
+    r = requests.get(f"{base_url}/isochrone/v1/mapbox/{profile}/{lon},{lat}?contours_minutes=30,60&contours_colors=6706ce,04e813&polygons=true&access_token={access}")
     response = r.json()
+    record_api_call('mapbox-isochrone', time.perf_counter()-start)
     try:
         iso30 = shapely.geometry.Polygon(response['features'][1]['geometry']['coordinates'][0])
         iso60 = shapely.geometry.Polygon(response['features'][0]['geometry']['coordinates'][0])
@@ -27,34 +39,15 @@ def isochrone(lon,lat,access=access):
     time.sleep(0.02)
     return iso30,iso60
 
-def haversine(pt1, pt2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    """
-    if 'tuple' in str(type(pt1)).lower():
-        lon1, lat1 = pt1
-        lon2, lat2 = pt2
-    else:
-        lon1, lat1 = pt1.x, pt1.y
-        lon2, lat2 = pt2.x, pt2.y
-
-    # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371 # Radius of earth in kilometers. Use 3956 for miles
-    return c * r
-
-def driving_time(sources,destinations,access=access,naive=False):
+def driving_time(sources,destinations,access=access,naive=False,base_url=MAPBOX_URL,profile='driving'):
     """
     Input:
     - sources: List of shapely coordinates
     - destinations: List of shapely coordinates
+    - access: Mapbox access token
+    - naive: Whether to use straight-line distance at 60 km/h instead of the API
+    - base_url: Base URL of the API
+    - profile: Mapbox routing profile
     
     Output:
     - result: n_sources x n_destinations matrix pertaining to drive times in minutes
@@ -87,8 +80,10 @@ def driving_time(sources,destinations,access=access,naive=False):
             destination = ";".join(destination)
             
             # API Call
-            r = requests.get(f"https://api.mapbox.com/directions-matrix/v1/mapbox/driving/{source};{destination}?sources=0&destinations={destination_ids}&access_token={access}")
+            start = time.perf_counter()
+            r = requests.get(f"{base_url}/directions-matrix/v1/mapbox/{profile}/{source};{destination}?sources=0&destinations={destination_ids}&access_token={access}")
             r = r.json()
+            record_api_call('mapbox-matrix', time.perf_counter()-start)
             
             # Update result matrix
             result[i][j*20:(j*20)+num_dests] = np.array(r['durations'])
@@ -5,9 +5,14 @@ import geopandas as gpd
 import requests
 import itertools
 import functools
+import heapq
+from collections import OrderedDict
+import scipy.sparse
+from multiprocessing import Pool, shared_memory
 import matplotlib
 import matplotlib.pyplot as plt
 from helper_functions.hrsl_site_helper import *
+from helper_functions.instrumentation_helper import stage_span, instrumented_stage
 
 import random
 
@@ -51,15 +56,157 @@ def reducer(p, c):
     return c
 
 def mapreduce(site_set_hrsl, mapper):
-    print("Map Step")
-    #step 1
-    mapped = map(mapper, iter(site_set_hrsl.values()))
-    mapped = zip(iter(site_set_hrsl.values()), mapped)
-    print("Reduce Step")
-    #step 2:
-    reduced = functools.reduce(reducer, mapped)
+    with stage_span('mapreduce', total=len(site_set_hrsl)) as span:
+        #step 1
+        mapped = map(mapper, iter(site_set_hrsl.values()))
+        mapped = zip(iter(site_set_hrsl.values()), mapped)
+        #step 2:
+        reduced = functools.reduce(reducer, span.track(mapped))
     return reduced
 
+# Parallel mapreduce over blocks of site sets
+_shared_arrays = {}
+
+def _attach_shared(specs):
+    """
+    Pool initializer, maps the shared memory blocks named in `specs`
+    into the worker's `_shared_arrays` without copying
+    """
+    for (key, (name, shape, dtype)) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+def _map_block(args):
+    """
+    Scores one block of site sets and keeps only its top_k entries
+    as tuples (score, set position, site ids); returns (block size, heap)
+    """
+    scorer, offset, block, top_k = args
+    arrays = {key:value[1] for (key,value) in _shared_arrays.items()}
+    scores = scorer(block, **arrays)
+    heap = []
+    for i, score in enumerate(scores):
+        item = (score, offset+i, tuple(int(x) for x in block[i]))
+        if len(heap) < top_k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return len(block), heap
+
+def _iter_blocks(site_sets, chunk_size):
+    if isinstance(site_sets, np.ndarray):
+        blocks = (site_sets[i:i+chunk_size] for i in range(0, len(site_sets), chunk_size))
+    else:
+        blocks = site_sets
+    offset = 0
+    for block in blocks:
+        block = np.asarray(block, dtype=int)
+        yield offset, block
+        offset += len(block)
+
+def mapreduce_parallel(site_sets, scorer, arrays, top_k=1, n_workers=None, chunk_size=256, site_coords=None):
+    """
+    Input:
+    - site_sets: n_sets x set_size integer array of site ids, or an iterable of such blocks
+    - scorer: Module-level function scorer(block, **arrays) returning one score per row
+              of block, e.g. `score_population_block` or `score_dist_decay_block`
+    - arrays: Dictionary of the read-only arrays passed to `scorer`, e.g. from
+              `coverage_arrays` or `dist_decay_arrays`; these are placed
+              in shared memory once instead of being pickled to every worker
+    - top_k: Number of highest scoring sets to keep
+    - n_workers: Number of processes, defaults to the CPU count; 1 runs in-process
+    - chunk_size: Number of sets per task when site_sets is an array
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    
+    Output:
+    - List of top_k tuples (site_set_dict, score), highest score first; the first
+      entry is what `mapreduce` returns for the same sets and metric
+    """
+    specs, blocks = {}, []
+    with stage_span('mapreduce_parallel', total=len(site_sets) if isinstance(site_sets, np.ndarray) else None) as span:
+        tasks = ((scorer, offset, block, top_k) for (offset, block) in _iter_blocks(site_sets, chunk_size))
+        # Progress counts the sets of each block as its result comes back
+        done = lambda results: [heap for (_, heap) in span.track(results, weight=lambda r: r[0])]
+        try:
+            if n_workers == 1:
+                _shared_arrays.update({key:(None, np.asarray(value)) for (key,value) in arrays.items()})
+                heaps = done(map(_map_block, tasks))
+            else:
+                # Copy each array into shared memory once
+                for (key, value) in arrays.items():
+                    value = np.ascontiguousarray(value)
+                    shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+                    np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+                    blocks.append(shm)
+                    specs[key] = (shm.name, value.shape, value.dtype)
+                with Pool(n_workers, initializer=_attach_shared, initargs=(specs,)) as pool:
+                    heaps = done(pool.imap_unordered(_map_block, tasks))
+        finally:
+            _shared_arrays.clear()
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    
+    # Merge the per-block heaps
+    ranked = heapq.nlargest(top_k, itertools.chain.from_iterable(heaps))
+    result = {i: {'site_ids': list(site_ids)} for (i, (_, _, site_ids)) in enumerate(ranked)}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return [(result[i], score) for (i, (score, _, _)) in enumerate(ranked)]
+
+def coverage_arrays(coverage, hrsl_pop):
+    """
+    Input:
+    - coverage: n_sites x n_HRSL CSR matrix from `make_site_hrsl_matrix`
+    - hrsl_pop: Array of populations per HRSL column from `make_site_hrsl_matrix`
+    
+    Output:
+    - Dictionary of plain arrays for `mapreduce_parallel` with `score_population_block`
+    """
+    return {'coverage_data': coverage.data, 'coverage_indices': coverage.indices,
+            'coverage_indptr': coverage.indptr, 'hrsl_pop': hrsl_pop}
+
+def score_population_block(block, coverage_data, coverage_indices, coverage_indptr, hrsl_pop):
+    """
+    Block scorer equivalent to `compute_metric_population_single`
+    """
+    coverage = scipy.sparse.csr_matrix((coverage_data, coverage_indices, coverage_indptr),
+                                       shape=(len(coverage_indptr)-1, len(hrsl_pop)))
+    return score_site_sets(coverage, hrsl_pop, block)
+
+def dist_decay_arrays(hrsl_pop, exp_demand):
+    """
+    Input:
+    - hrsl_pop: List of HRSL populations, ordered by HRSL_id
+    - exp_demand: n_HRSL_points x n_facilities matrix of expected demand values
+    
+    Output:
+    - Dictionary of arrays for `mapreduce_parallel` with `score_dist_decay_block`;
+      exp_demand is stored site-major so each site's column is contiguous
+    """
+    return {'hrsl_pop': np.asarray(hrsl_pop, dtype=float),
+            'exp_demand_t': np.ascontiguousarray(np.asarray(exp_demand).T)}
+
+def score_dist_decay_block(block, hrsl_pop, exp_demand_t):
+    """
+    Block scorer equivalent to `compute_metric_dist_decay_single`, 
+    subtracting the sites in the same order for every set in the block
+    """
+    total_demand = np.zeros(len(block))
+    residual_pop = np.tile(hrsl_pop, (len(block), 1))
+    for j in range(block.shape[1]):
+        actual_demand = np.minimum(exp_demand_t[block[:,j]], residual_pop)
+        residual_pop = residual_pop - actual_demand
+        total_demand += np.nansum(actual_demand, axis=1)
+    return total_demand
+
+def score_competition_block(block, site_attractiveness):
+    """
+    Block scorer equivalent to `compute_metric_competition_single`, 
+    with site_attractiveness as an array indexed by site id
+    """
+    return np.nansum(site_attractiveness[block], axis=1)
+
 # Metric calculation functions
 def calculate_no_competition(demand_matrix, k, site_coords):
     scores = demand_matrix.sum(axis=0)
@@ -96,78 +243,215 @@ def compute_metric_dist_decay_single(dct, hrsl_pop_c, exp_demand):
         total_demand += np.nansum(actual_demand)
     return total_demand
 
+def compute_metric_dist_decay_prefix(site_set_hrsl, hrsl_pop_c, exp_demand, memory_budget=2**30):
+    """
+    Input:
+    - site_set_hrsl: Dictionary of site sets
+    - hrsl_pop_c: List of HRSL populations, ordered by HRSL_id
+    - exp_demand: n_HRSL_points x n_facilities matrix of expected demand values
+    - memory_budget: Maximum number of bytes of cached residual populations
+    
+    Output:
+    - scores: Dictionary with the same keys as site_set_hrsl, and the
+      `compute_metric_dist_decay_single` score (bit-for-bit) as value
+    
+    Note:
+    Sets are visited in lexicographic order of their site_ids; the residual 
+    population and running total after every proper prefix are kept in an LRU 
+    cache, so each set only subtracts the sites after its longest cached prefix
+    """
+    hrsl_pop = np.array(hrsl_pop_c.copy())
+    exp_demand_t = np.ascontiguousarray(np.asarray(exp_demand).T)
+    max_entries = max(memory_budget // max(hrsl_pop.nbytes, 1), 1)
+    
+    cache, scores = OrderedDict(), {}
+    for key in sorted(site_set_hrsl, key=lambda key: tuple(site_set_hrsl[key]['site_ids'])):
+        site_ids = tuple(site_set_hrsl[key]['site_ids'])
+        
+        # Start from the longest cached prefix
+        start, residual_pop, total_demand = 0, hrsl_pop, 0
+        for length in range(len(site_ids)-1, 0, -1):
+            if site_ids[:length] in cache:
+                cache.move_to_end(site_ids[:length])
+                residual_pop, total_demand = cache[site_ids[:length]]
+                start = length
+                break
+        
+        for pos in range(start, len(site_ids)):
+            actual_demand = np.minimum(exp_demand_t[site_ids[pos]], residual_pop)
+            residual_pop = residual_pop - actual_demand
+            total_demand += np.nansum(actual_demand)
+            if pos < len(site_ids)-1:
+                cache[site_ids[:pos+1]] = (residual_pop, total_demand)
+                if len(cache) > max_entries:
+                    cache.popitem(last=False)
+        scores[key] = total_demand
+    return scores
+
+def mapreduce_dist_decay_prefix(site_set_hrsl, hrsl_pop_c, exp_demand, memory_budget=2**30):
+    """
+    Input:
+    - Same as `compute_metric_dist_decay_prefix`
+    
+    Output:
+    - Same as mapreduce(site_set_hrsl, lambda dct: compute_metric_dist_decay_single(dct, hrsl_pop_c, exp_demand))
+    """
+    scores = compute_metric_dist_decay_prefix(site_set_hrsl, hrsl_pop_c, exp_demand, memory_budget)
+    return functools.reduce(reducer, ((dct, scores[key]) for (key, dct) in site_set_hrsl.items()))
+
+@instrumented_stage(items=lambda hrsl_pop_column, *args, **kwargs: len(hrsl_pop_column))
 def compute_exp_demand(hrsl_pop_column, time_matrix_c, beds, u, a, s, b, t):
-    demand = time_matrix_c.copy()
-    compute_exp_demand = lambda col: [expected_demand(pop, 
-                                                      dist_decay(d, b, t), 
-                                                      beds, 
-                                                      u, 
-                                                      a, 
-                                                      s) for (pop, d) in zip(hrsl_pop_column, 
-                                                                             col)]
-    exp_demand = np.apply_along_axis(compute_exp_demand, 0, demand)
+    """
+    Input:
+    - hrsl_pop_column: List of populations for n_HRSL_points
+    - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
+    - beds, u, a, s: Constants for `expected_demand`
+    - b, t: Constants for `dist_decay`
+    
+    Output:
+    - exp_demand: n_HRSL_points x n_sites matrix of expected demand values
+    """
+    hrsl_pop = np.asarray(hrsl_pop_column, dtype=float)[:, np.newaxis]
+    time_matrix = np.asarray(time_matrix_c, dtype=float)
+    exp_demand = expected_demand(hrsl_pop, dist_decay(time_matrix, b, t), beds, u, a, s)
+    return exp_demand
+
+def compute_exp_demand_batch(hrsl_pop_columns, time_matrix_c, beds, u, a, s, b, t):
+    """
+    Input:
+    - hrsl_pop_columns: List of populations for n_HRSL_points, or an 
+                        n_params x n_HRSL_points matrix with one population 
+                        column per parameter set (e.g. original, zeroed and 
+                        expected demand)
+    - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
+    - beds, u, a, s, b, t: Scalars or lists of length n_params, 
+                           broadcast against each other
+    
+    Output:
+    - exp_demand: n_params x n_HRSL_points x n_sites tensor of expected demand values,
+                  where exp_demand[p] equals compute_exp_demand with the p-th parameters
+    """
+    hrsl_pop = np.asarray(hrsl_pop_columns, dtype=float)
+    hrsl_pop = hrsl_pop[np.newaxis] if hrsl_pop.ndim == 1 else hrsl_pop
+    time_matrix = np.asarray(time_matrix_c, dtype=float)
+    
+    # Broadcast the parameters (and populations) into n_params entries
+    params = [np.atleast_1d(np.asarray(p, dtype=float)) for p in (beds, u, a, s, b, t)]
+    n_params = np.broadcast_shapes(hrsl_pop.shape[:1], *[p.shape for p in params])[0]
+    beds, u, a, s, b, t = [np.broadcast_to(p, (n_params,))[:, np.newaxis, np.newaxis] for p in params]
+    hrsl_pop = np.broadcast_to(hrsl_pop, (n_params, hrsl_pop.shape[1]))[:, :, np.newaxis]
+    
+    exp_demand = expected_demand(hrsl_pop, dist_decay(time_matrix[np.newaxis], b, t), beds, u, a, s)
     return exp_demand
 
-def compute_hospital_attractiveness(hosp_matrix_c, bed_capacity):
+def compute_hospital_attractiveness(hosp_matrix_c, bed_capacity, s=0.40, b=2.14, t=6.29):
     """
     Input:
     - hosp_matrix_c: n_HRSL_points x n_hospitals matrix of drive times
     - bed_capacity: List of bed capacities of n_hospitals in the same order as hosp_matrix_c
+    - s: Constant for `attractiveness_score`
+    - b, t: Constants for `dist_decay`
     
     Output:
-    - hosp_matrix[0]: List of total hospital_attractiveness values for n_sites
+    - hospital_attractiveness: List of total hospital_attractiveness values for n_HRSL_points
     """
-    # Turn matrices into dataframes
-    hosp_matrix = pd.DataFrame(hosp_matrix_c.copy()) if not 'DataFrame' in str(type(hosp_matrix_c)) else hosp_matrix_c.copy()
+    hosp_matrix = np.asarray(hosp_matrix_c, dtype=float)
+    beds = np.asarray(bed_capacity, dtype=float)[np.newaxis, :]
 
-    # Compute "attractiveness score" from each population center to each existing hospital
-    for i, row in hosp_matrix.iterrows():
-        hosp_matrix.loc[i] = [attractiveness_score(beds, dist_decay(d)) for (beds,d) in zip(bed_capacity, row)]
+    # Compute "attractiveness score" from each population center to each existing hospital,
+    # then get the current total attractiveness score at each HRSL point
+    hospital_attractiveness = np.nansum(attractiveness_score(beds, dist_decay(hosp_matrix, b, t), s), axis=1)
+    return pd.Series(hospital_attractiveness)
 
-    # Get the current total attractiveness score at each HRSL point
-    hosp_matrix = hosp_matrix.sum(axis=1).reset_index()
+def compute_attractiveness_matrix(time_matrix_c, beds=100, s=0.40, b=2.14, t=6.29):
+    """
+    Input:
+    - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
+    - beds: Number of beds per new site, or list of n_sites bed counts
+    - s: Constant for `attractiveness_score`
+    - b, t: Constants for `dist_decay`
     
-    return hosp_matrix[0]
+    Output:
+    - n_HRSL_points x n_sites matrix of attractiveness scores of the new sites
+    """
+    time_matrix = np.asarray(time_matrix_c, dtype=float)
+    beds = np.asarray(beds, dtype=float)
+    return attractiveness_score(beds, dist_decay(time_matrix, b, t), s)
 
-def compute_site_attractiveness(time_matrix_c, hospital_attractiveness, hrsl_pop):
+@instrumented_stage(items=lambda time_matrix_c, *args, **kwargs: np.shape(time_matrix_c)[0])
+def compute_site_attractiveness(time_matrix_c, hospital_attractiveness, hrsl_pop, 
+                                beds=100, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29):
     """
     Input:
     - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
-    - hospital_attractiveness: List of total hospital_attractiveness values for n_sites
+    - hospital_attractiveness: List of total hospital_attractiveness values for n_HRSL_points
     - hrsl_pop: List of populations for n_HRSL_points
+    - beds: Number of beds per new site, or list of n_sites bed counts
+    - u, a, s: Constants for `expected_demand_norm`
+    - b, t: Constants for `dist_decay`
     
     Output:
     - site_attractiveness: Dictionary of n_sites values where the key is the site ID,
     and the attractiveness value is the value
     """
-    # Turn the site set-HRSL matrix into a dataframe
-    time_matrix = pd.DataFrame(time_matrix_c.copy()) if not 'DataFrame' in str(type(time_matrix_c)) else time_matrix_c.copy()
-    
-    # Add the attractiveness score column to the site set-HRSL matrix
-    time_matrix['norm'] = hospital_attractiveness
+    keys = time_matrix_c.columns if 'DataFrame' in str(type(time_matrix_c)) else range(np.shape(time_matrix_c)[1])
+    score = compute_attractiveness_matrix(time_matrix_c, beds, s, b, t)
+    norm = np.asarray(hospital_attractiveness, dtype=float)[:, np.newaxis]
+    hrsl_pop = np.asarray(hrsl_pop, dtype=float)[:, np.newaxis]
     
     # Calculate score per site set-HRSL pair, 
     # incorporating population, distance decay, 
     # current attractiveness score from other hospitals, and beds
-    for i, row in time_matrix.iterrows():
-        if i%1000==0:
-            print(i)
-        for col in time_matrix.columns[:-1]:
-            time_matrix.loc[i, col] = expected_demand_norm(hrsl_pop[i], 
-                                                           dist_decay(row[col]),
-                                                           row['norm'],
-                                                           100)
-    # Remove the norm before summing
-    time_matrix = time_matrix.drop('norm', axis=1)
+    demand = u*(hrsl_pop**a)*score/(score+norm)
 
     # Sum total expected visitors per site
-    site_attractiveness = time_matrix.T.sum(axis=1).reset_index()
-    
-    # Turn into dictionary
-    site_attractiveness = {key:value for (key,value) in zip(site_attractiveness['index'],
-                                                            site_attractiveness[0])}
+    site_attractiveness = {key:value for (key,value) in zip(keys, np.nansum(demand, axis=0))}
     return site_attractiveness
 
+def competition_arrays(time_matrix_c, hospital_attractiveness, hrsl_pop, 
+                       beds=100, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29):
+    """
+    Input:
+    - Same as `compute_site_attractiveness`
+    
+    Output:
+    - Dictionary of arrays for `mapreduce_parallel` with `score_site_set_competition_block`;
+      the attractiveness matrix is stored site-major
+    """
+    score = compute_attractiveness_matrix(time_matrix_c, beds, s, b, t)
+    return {'attractiveness_t': np.ascontiguousarray(score.T),
+            'hrsl_weight': u*(np.asarray(hrsl_pop, dtype=float)**a),
+            'norm': np.asarray(hospital_attractiveness, dtype=float)}
+
+def score_site_set_competition_block(block, attractiveness_t, hrsl_weight, norm):
+    """
+    Block scorer for the demand captured by whole site sets, where the new sites
+    compete with each other as well as with the existing hospitals (Huff model)
+    """
+    set_score = attractiveness_t[block].sum(axis=1)
+    return np.nansum(hrsl_weight*set_score/(set_score+norm), axis=1)
+
+def compute_site_set_competition(time_matrix_c, hospital_attractiveness, hrsl_pop, site_sets,
+                                 beds=100, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29, chunk_size=256):
+    """
+    Input:
+    - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
+    - hospital_attractiveness: List of total hospital_attractiveness values for n_HRSL_points
+    - hrsl_pop: List of populations for n_HRSL_points
+    - site_sets: n_sets x set_size integer array of site ids
+    - beds: Number of beds per new site, or list of n_sites bed counts
+    - u, a, s: Constants for `expected_demand_norm`
+    - b, t: Constants for `dist_decay`
+    - chunk_size: Number of sets scored at once
+    
+    Output:
+    - Array of the total expected visitors captured by each site set
+    """
+    arrays = competition_arrays(time_matrix_c, hospital_attractiveness, hrsl_pop, beds, u, a, s, b, t)
+    site_sets = np.asarray(site_sets, dtype=int)
+    return np.concatenate([score_site_set_competition_block(site_sets[i:i+chunk_size], **arrays)
+                           for i in range(0, len(site_sets), chunk_size)])
+
 def compute_metric_competition(site_set_hrsl, site_attractiveness):
     """
     Input:
@@ -0,0 +1,516 @@
+import numpy as np
+import heapq
+import time
+import scipy.sparse
+from scipy.optimize import milp, LinearConstraint, Bounds
+
+from helper_functions.hrsl_site_helper import *
+from helper_functions.metrics_helper import compute_metric_dist_decay_single, compute_attractiveness_matrix
+from helper_functions.instrumentation_helper import stage_span, instrumented_stage
+
+def make_site_coverage(site_hrsl_dict):
+    """
+    Input:
+    - site_hrsl_dict: Dictionary with site index as key,
+                      and list of tuples (hrsl_idx, population)
+                      as value, from `make_site_hrsl_dict`
+
+    Output:
+    - coverage: Dictionary with site index as key, and array of
+                HRSL positions (into `hrsl_pop`) covered by the site as value
+    - hrsl_pop: Array of populations per HRSL position, NaNs set to 0
+    - hrsl_ids: Array of HRSL indices per HRSL position
+    """
+    # Assign a position to every HRSL index that appears in any isochrone
+    pairs = [pair for value in site_hrsl_dict.values() for pair in value if pair[0]==pair[0]]
+    hrsl_ids = np.unique([pair[0] for pair in pairs]).astype(int)
+    positions = {idx:i for (i,idx) in enumerate(hrsl_ids)}
+
+    hrsl_pop = np.zeros(len(hrsl_ids))
+    for (idx, pop) in pairs:
+        hrsl_pop[positions[int(idx)]] = pop
+    hrsl_pop = np.nan_to_num(hrsl_pop)
+
+    coverage = {key:np.unique([positions[int(idx)] for (idx, _) in value if idx==idx]).astype(int)
+                for (key, value) in site_hrsl_dict.items()}
+    return coverage, hrsl_pop, hrsl_ids
+
+def lazy_greedy_population(site_hrsl_dict, k, redundant_dict=None, site_coords=None):
+    """
+    Input:
+    - site_hrsl_dict: Dictionary with site index as key,
+                      and list of tuples (hrsl_idx, population)
+                      as value, from `make_site_hrsl_dict`
+    - k: Number of sites to select
+    - redundant_dict: Dictionary containing site ids as keys, and list of
+                      redundant sites as value (from `generate_redundant_sites`);
+                      a site is never selected together with a redundant site
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+
+    Output:
+    Tuple (site_set_dict, score) in the same form as `mapreduce`, where site_set_dict
+    contains (1) site_ids: selected site IDs in order of selection,
+             (2) population: populations of the covered HRSL points,
+             (3) hrsl_ids: covered HRSL IDs,
+             (4) gains: marginal population gained at each step
+
+    Note:
+    Greedily adds the site with the largest marginal covered population,
+    re-evaluating stale gains lazily from a priority queue. Without redundant
+    sites the result is within (1-1/e) of the optimal coverage.
+    """
+    redundant_dict = redundant_dict if redundant_dict else {}
+    coverage, hrsl_pop, hrsl_ids = make_site_coverage(site_hrsl_dict)
+    covered = np.zeros(len(hrsl_pop), dtype=bool)
+
+    # Priority queue of (negative gain upper bound, site id)
+    heap = [(-hrsl_pop[idx].sum(), key) for (key, idx) in coverage.items()]
+    heapq.heapify(heap)
+
+    site_ids, gains, blocked, evaluations = [], [], set(), 0
+    with stage_span('lazy_greedy_population', total=k) as span:
+        while len(site_ids) < k and heap:
+            _, site = heapq.heappop(heap)
+            if site in blocked:
+                continue
+
+            # Re-evaluate the gain; keep the site only if it still beats every other bound
+            idx = coverage[site]
+            gain = hrsl_pop[idx[~covered[idx]]].sum()
+            evaluations += 1
+            if heap and gain < -heap[0][0]:
+                heapq.heappush(heap, (-gain, site))
+                continue
+
+            site_ids.append(site)
+            gains.append(float(gain))
+            covered[idx] = True
+            blocked.update(redundant_dict.get(site, []))
+            span.advance()
+        span.record(evaluations=evaluations)
+
+    result = {0: {'site_ids': site_ids,
+                  'population': list(hrsl_pop[covered]),
+                  'hrsl_ids': list(hrsl_ids[covered]),
+                  'gains': gains}}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return result[0], np.sum(gains)
+
+def _conflict_rows(site_ids, redundant_dict):
+    """
+    Input:
+    - site_ids: List of candidate site IDs, in variable order
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+
+    Output:
+    - Sparse matrix with one row per redundant pair, enforcing x_a + x_b <= 1
+    """
+    positions = {key:i for (i,key) in enumerate(site_ids)}
+    pairs = {tuple(sorted((positions[a], positions[b])))
+             for (a, lst) in (redundant_dict or {}).items() if a in positions
+             for b in lst if b in positions and b != a}
+    pairs = np.array(sorted(pairs), dtype=int).reshape(-1, 2)
+    rows = np.repeat(np.arange(len(pairs)), 2)
+    return scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, pairs.flatten())),
+                                   shape=(len(pairs), len(site_ids)))
+
+def _greedy_matrix(W, state, combine, value, k, redundant_dict, site_ids):
+    """
+    Input:
+    - W: n_HRSL_points x n_sites matrix of per-site service values
+    - state: Initial service value per HRSL point
+    - combine: Function merging the service state with a site column (e.g. np.add, np.minimum)
+    - value: Function mapping an n_HRSL_points x n_sites state matrix to objective contributions
+    - k: Number of sites to select
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_ids: List of site IDs, ordered as the columns of W
+
+    Output:
+    - chosen: List of selected column positions, used to warm start the MILP solvers
+    """
+    positions = {key:i for (i,key) in enumerate(site_ids)}
+    available = np.ones(len(site_ids), dtype=bool)
+    chosen = []
+    for _ in range(k):
+        if not available.any():
+            break
+        scores = value(combine(state[:, np.newaxis], W)).sum(axis=0)
+        j = int(np.argmax(np.where(available, scores, -np.inf)))
+        chosen.append(j)
+        state = combine(state, W[:, j])
+        available[j] = False
+        available[[positions[b] for b in (redundant_dict or {}).get(site_ids[j], []) if b in positions]] = False
+    return chosen
+
+def _solve_site_milp(c, n_sites, k, constraints, upper, redundant_dict, site_ids, heuristic,
+                     time_limit, mip_rel_gap):
+    """
+    Solves min c^T [x, z] where x are n_sites binary site choices and z are continuous
+    variables in [0, upper], subject to `constraints`, sum(x) <= k, and the redundant
+    site conflicts. `heuristic` is a (site positions, objective) warm start; it is
+    passed as an objective cutoff and returned if the solver finds nothing better
+    within the time limit.
+
+    Output:
+    - Tuple (selected site positions, objective value, info dictionary)
+    """
+    n_vars = len(c)
+    integrality = np.zeros(n_vars)
+    integrality[:n_sites] = 1
+    bounds = Bounds(np.zeros(n_vars), np.concatenate([np.ones(n_sites), upper]))
+
+    # Cardinality and conflict constraints on the site variables
+    pad = lambda m: scipy.sparse.hstack([m, scipy.sparse.csr_matrix((m.shape[0], n_vars-n_sites))])
+    constraints = constraints + [LinearConstraint(pad(scipy.sparse.csr_matrix(np.ones((1, n_sites)))), 0, k)]
+    conflicts = _conflict_rows(site_ids, redundant_dict)
+    if conflicts.shape[0]:
+        constraints.append(LinearConstraint(pad(conflicts), 0, 1))
+
+    # Warm start: the solution has to be at least as good as the heuristic
+    if heuristic is not None:
+        cutoff = heuristic[1] + 1e-6*abs(heuristic[1])
+        constraints.append(LinearConstraint(scipy.sparse.csr_matrix(c), -np.inf, cutoff))
+
+    res = milp(c, integrality=integrality, bounds=bounds, constraints=constraints,
+               options={'time_limit': time_limit, 'mip_rel_gap': mip_rel_gap})
+
+    info = {'status': res.status, 'message': res.message,
+            'mip_gap': getattr(res, 'mip_gap', None),
+            'heuristic_score': None if heuristic is None else -heuristic[1]}
+    if res.x is None:
+        if heuristic is None:
+            raise ValueError(f"MILP solver found no solution: {res.message}")
+        return list(heuristic[0]), heuristic[1], info
+    return [int(j) for j in np.flatnonzero(res.x[:n_sites] > 0.5)], res.fun, info
+
+@instrumented_stage()
+def solve_max_covering_milp(site_hrsl_dict, k, redundant_dict=None, site_coords=None,
+                            time_limit=60, mip_rel_gap=1e-4, warm_start=True):
+    """
+    Input:
+    - site_hrsl_dict: Dictionary with site index as key,
+                      and list of tuples (hrsl_idx, population)
+                      as value, from `make_site_hrsl_dict`
+    - k: Number of sites to select
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - time_limit: Maximum number of seconds for the solver
+    - mip_rel_gap: Relative optimality gap at which the solver stops
+    - warm_start: Whether to start from the `lazy_greedy_population` solution
+
+    Output:
+    Tuple (site_set_dict, score) in the same form as `mapreduce`, where site_set_dict
+    contains site_ids, population, hrsl_ids, and the solver status, message, 
+    mip_gap and heuristic_score
+
+    Note:
+    Maximal covering model; maximize sum(pop_i * y_i) subject to
+    y_i <= sum(x_j for sites j covering i), 0 <= y_i <= 1 and sum(x_j) <= k
+    """
+    coverage, hrsl_pop, hrsl_ids = make_site_coverage(site_hrsl_dict)
+    site_ids = list(coverage.keys())
+    n_sites, n_hrsl = len(site_ids), len(hrsl_pop)
+
+    # Site x HRSL incidence matrix
+    rows = np.concatenate([[j]*len(coverage[key]) for (j, key) in enumerate(site_ids)]).astype(int)
+    cols = np.concatenate([coverage[key] for key in site_ids]).astype(int)
+    incidence = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_sites, n_hrsl))
+
+    # y_i - sum_j x_j <= 0
+    A = scipy.sparse.hstack([-incidence.T, scipy.sparse.identity(n_hrsl)]).tocsr()
+    c = np.concatenate([np.zeros(n_sites), -hrsl_pop])
+
+    heuristic = None
+    if warm_start:
+        greedy, score = lazy_greedy_population(site_hrsl_dict, k, redundant_dict)
+        heuristic = ([site_ids.index(key) for key in greedy['site_ids']], -score)
+
+    chosen, _, info = _solve_site_milp(c, n_sites, k, [LinearConstraint(A, -np.inf, 0)], np.ones(n_hrsl),
+                                       redundant_dict, site_ids, heuristic, time_limit, mip_rel_gap)
+
+    covered = np.zeros(n_hrsl, dtype=bool)
+    for j in chosen:
+        covered[coverage[site_ids[j]]] = True
+    result = {0: {'site_ids': sorted(site_ids[j] for j in chosen),
+                  'population': list(hrsl_pop[covered]),
+                  'hrsl_ids': list(hrsl_ids[covered]),
+                  **info}}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return result[0], hrsl_pop[covered].sum()
+
+@instrumented_stage()
+def solve_dist_decay_milp(hrsl_pop_c, exp_demand, k, redundant_dict=None, site_coords=None,
+                          time_limit=60, mip_rel_gap=1e-4, warm_start=True):
+    """
+    Input:
+    - hrsl_pop_c: List of HRSL populations, ordered by HRSL_id
+    - exp_demand: n_HRSL_points x n_facilities matrix of expected demand values,
+                  from `compute_exp_demand`
+    - k: Number of sites to select
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - time_limit: Maximum number of seconds for the solver
+    - mip_rel_gap: Relative optimality gap at which the solver stops
+    - warm_start: Whether to start from a greedy solution
+
+    Output:
+    Tuple (site_set_dict, score) in the same form as `mapreduce`, where the score is
+    `compute_metric_dist_decay_single` of the chosen sites and site_set_dict contains
+    site_ids and the solver status, message, mip_gap and heuristic_score
+
+    Note:
+    The demand served at HRSL point i by `compute_metric_dist_decay_single` is
+    min(pop_i, sum of exp_demand[i, j] over chosen sites j); this is modelled as
+    maximize sum(z_i) subject to z_i <= sum(exp_demand[i, j] * x_j), 0 <= z_i <= pop_i
+    """
+    hrsl_pop = np.nan_to_num(np.array(hrsl_pop_c, dtype=float))
+    demand = np.nan_to_num(np.asarray(exp_demand, dtype=float))
+    n_hrsl, n_sites = demand.shape
+    site_ids = list(range(n_sites))
+
+    # z_i - sum_j exp_demand_ij x_j <= 0
+    A = scipy.sparse.hstack([-scipy.sparse.csr_matrix(demand), scipy.sparse.identity(n_hrsl)]).tocsr()
+    c = np.concatenate([np.zeros(n_sites), -np.ones(n_hrsl)])
+
+    heuristic = None
+    if warm_start:
+        greedy = _greedy_matrix(demand, np.zeros(n_hrsl), np.add,
+                                lambda state: np.minimum(hrsl_pop.reshape(-1, *[1]*(state.ndim-1)), state),
+                                k, redundant_dict, site_ids)
+        heuristic = (greedy, -np.minimum(hrsl_pop, demand[:, greedy].sum(axis=1)).sum())
+
+    chosen, _, info = _solve_site_milp(c, n_sites, k, [LinearConstraint(A, -np.inf, 0)], hrsl_pop,
+                                       redundant_dict, site_ids, heuristic, time_limit, mip_rel_gap)
+
+    result = {0: {'site_ids': sorted(chosen), **info}}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return result[0], compute_metric_dist_decay_single(result[0], hrsl_pop_c, exp_demand)
+
+@instrumented_stage()
+def solve_p_median_milp(hrsl_pop_c, time_matrix_c, k, redundant_dict=None, site_coords=None,
+                        time_limit=60, mip_rel_gap=1e-4, warm_start=True):
+    """
+    Input:
+    - hrsl_pop_c: List of HRSL populations, ordered by HRSL_id
+    - time_matrix_c: n_HRSL_points x n_sites matrix of drive times
+    - k: Number of sites to select
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - time_limit: Maximum number of seconds for the solver
+    - mip_rel_gap: Relative optimality gap at which the solver stops
+    - warm_start: Whether to start from a greedy solution
+
+    Output:
+    Tuple (site_set_dict, score) in the same form as `mapreduce`, where the score is
+    the population-weighted travel time to the nearest chosen site (lower is better)
+
+    Note:
+    p-median model with n_HRSL_points x n_sites assignment variables; 
+    minimize sum(pop_i * time_ij * z_ij) subject to sum_j z_ij = 1, z_ij <= x_j
+    """
+    hrsl_pop = np.nan_to_num(np.array(hrsl_pop_c, dtype=float))
+    time_matrix = np.asarray(time_matrix_c, dtype=float)
+    time_matrix = np.where(np.isfinite(time_matrix), time_matrix, 10*np.nanmax(time_matrix[np.isfinite(time_matrix)]))
+    n_hrsl, n_sites = time_matrix.shape
+    site_ids = list(range(n_sites))
+
+    # Assignment variables z_ij are stored row-major after the site variables
+    n_assign = n_hrsl*n_sites
+    assign = scipy.sparse.identity(n_assign, format='csr')
+    link = scipy.sparse.hstack([-scipy.sparse.vstack([scipy.sparse.identity(n_sites)]*n_hrsl), assign])
+    total = scipy.sparse.hstack([scipy.sparse.csr_matrix((n_hrsl, n_sites)),
+                                 scipy.sparse.kron(scipy.sparse.identity(n_hrsl), np.ones((1, n_sites)))])
+    constraints = [LinearConstraint(link.tocsr(), -np.inf, 0), LinearConstraint(total.tocsr(), 1, 1)]
+    c = np.concatenate([np.zeros(n_sites), (hrsl_pop[:, np.newaxis]*time_matrix).flatten()])
+
+    heuristic = None
+    if warm_start:
+        greedy = _greedy_matrix(time_matrix, np.full(n_hrsl, time_matrix.max()), np.minimum,
+                                lambda state: -hrsl_pop.reshape(-1, *[1]*(state.ndim-1))*state,
+                                k, redundant_dict, site_ids)
+        heuristic = (greedy, (hrsl_pop*time_matrix[:, greedy].min(axis=1)).sum())
+
+    chosen, objective, info = _solve_site_milp(c, n_sites, k, constraints, np.ones(n_assign),
+                                               redundant_dict, site_ids, heuristic, time_limit, mip_rel_gap)
+    if heuristic is not None:
+        info['heuristic_score'] = heuristic[1]
+
+    result = {0: {'site_ids': sorted(chosen), **info}}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return result[0], (hrsl_pop*time_matrix[:, chosen].min(axis=1)).sum()
+
+def make_swap_objective(kind, site_hrsl_dict=None, hrsl_pop=None, exp_demand=None, time_matrix=None,
+                        hospital_attractiveness=None, beds=100, u=0.20, a=0.66, s=0.40, b=2.14, t=6.29):
+    """
+    Input:
+    - kind: 'population' (needs site_hrsl_dict), 'dist_decay' (needs hrsl_pop and exp_demand),
+            or 'competition' (needs time_matrix, hospital_attractiveness and hrsl_pop)
+    - Remaining arguments as in `make_site_hrsl_dict`, `compute_metric_dist_decay_single`
+      and `compute_site_attractiveness`
+
+    Output:
+    Dictionary with
+    - W: n_HRSL_points x n_sites CSC matrix of each site's service value per point
+    - value: Function (service, rows) -> objective contribution of the points `rows`,
+             where service is the sum of W over the chosen sites
+    - site_ids: List of candidate site IDs
+
+    Note:
+    For all three objectives a point's contribution only depends on the summed service
+    of the chosen sites (coverage count, expected demand, Huff attractiveness)
+    """
+    if kind=='population':
+        # Columns follow site_ids, so site keys need not be contiguous
+        site_ids = sorted(site_hrsl_dict.keys())
+        coverage, pop, _ = make_site_hrsl_matrix({i:site_hrsl_dict[key] for (i,key) in enumerate(site_ids)},
+                                                 len(site_ids))
+        W = coverage.T.astype(float).tocsc()
+        value = lambda service, rows: pop[rows]*(service > 0)
+    elif kind=='dist_decay':
+        pop = np.nan_to_num(np.array(hrsl_pop, dtype=float))
+        W = scipy.sparse.csc_matrix(np.nan_to_num(np.asarray(exp_demand, dtype=float)))
+        value = lambda service, rows: np.minimum(pop[rows], service)
+        site_ids = list(range(W.shape[1]))
+    elif kind=='competition':
+        weight = np.nan_to_num(u*(np.asarray(hrsl_pop, dtype=float)**a))
+        norm = np.asarray(hospital_attractiveness, dtype=float)
+        W = scipy.sparse.csc_matrix(np.nan_to_num(compute_attractiveness_matrix(time_matrix, beds, s, b, t)))
+        value = lambda service, rows: np.nan_to_num(weight[rows]*service/(service+norm[rows]))
+        site_ids = list(range(W.shape[1]))
+    else:
+        raise ValueError(f"Unknown objective: {kind}")
+    return {'W': W, 'value': value, 'site_ids': site_ids}
+
+def _swap_delta(objective, service, j, l):
+    """
+    Change in objective from swapping site column j out and site column l in,
+    computed only over the HRSL points served by either site
+    """
+    W = objective['W']
+    rows_j, vals_j = W.indices[W.indptr[j]:W.indptr[j+1]], W.data[W.indptr[j]:W.indptr[j+1]]
+    rows_l, vals_l = W.indices[W.indptr[l]:W.indptr[l+1]], W.data[W.indptr[l]:W.indptr[l+1]]
+    rows = np.union1d(rows_j, rows_l)
+    change = np.zeros(len(rows))
+    change[np.searchsorted(rows, rows_j)] -= vals_j
+    change[np.searchsorted(rows, rows_l)] += vals_l
+    new_service = service[rows] + change
+    delta = objective['value'](new_service, rows).sum() - objective['value'](service[rows], rows).sum()
+    return delta, rows, new_service
+
+def swap_local_search(objective, initial_site_ids, redundant_dict=None, site_coords=None,
+                      deadline=None, tol=1e-9):
+    """
+    Input:
+    - objective: Dictionary from `make_swap_objective`
+    - initial_site_ids: Starting site set, e.g. from `lazy_greedy_population`,
+                        `calculate_no_competition` or `mapreduce`
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - deadline: time.time() value after which no further swaps are tried, optional
+    - tol: Minimum improvement for a swap to be applied
+
+    Output:
+    Tuple (site_set_dict, score) in the same form as `mapreduce`, where site_set_dict
+    contains site_ids, n_swaps and history (score after each applied swap)
+
+    Note:
+    Vertex substitution (Teitz and Bart); for every site outside the solution the
+    best site to swap out is found, and the swap is applied if it improves the
+    score. The summed service per HRSL point is updated in place, so evaluating a
+    swap only touches the points served by the two sites involved.
+    """
+    redundant_dict = redundant_dict if redundant_dict else {}
+    positions = {key:i for (i,key) in enumerate(objective['site_ids'])}
+    chosen = [positions[key] for key in initial_site_ids]
+    W = objective['W']
+
+    x = np.zeros(W.shape[1])
+    x[chosen] = 1
+    service = W @ x
+    score = objective['value'](service, np.arange(len(service))).sum()
+    history = [score]
+
+    with stage_span('swap_local_search') as span:
+        improved = True
+        while improved and not (deadline and time.time() > deadline):
+            improved = False
+            # Progress counts the incoming sites evaluated
+            for l in span.track(range(W.shape[1])):
+                if l in chosen:
+                    continue
+                # The incoming site may only conflict with the site it replaces
+                conflicts = [j for j in chosen if objective['site_ids'][j] in redundant_dict.get(objective['site_ids'][l], [])]
+                if len(conflicts) > 1:
+                    continue
+                best = (tol, None, None, None)
+                for j in (conflicts if conflicts else chosen):
+                    delta, rows, new_service = _swap_delta(objective, service, j, l)
+                    if delta > best[0]:
+                        best = (delta, j, rows, new_service)
+                if best[1] is not None:
+                    delta, j, rows, new_service = best
+                    service[rows] = new_service
+                    chosen[chosen.index(j)] = l
+                    score += delta
+                    history.append(score)
+                    improved = True
+                if deadline and time.time() > deadline:
+                    break
+        span.record(n_swaps=len(history)-1)
+
+    # Recompute the final score to avoid accumulated rounding
+    score = objective['value'](service, np.arange(len(service))).sum()
+    result = {0: {'site_ids': sorted(objective['site_ids'][j] for j in chosen),
+                  'n_swaps': len(history)-1,
+                  'history': history}}
+    if site_coords:
+        result = add_coords(result, site_coords)
+    return result[0], score
+
+def multi_start_local_search(objective, k, time_budget=60, n_starts=None, initial_site_ids=None,
+                             redundant_dict=None, site_coords=None, seed=None):
+    """
+    Input:
+    - objective: Dictionary from `make_swap_objective`
+    - k: Number of sites to select
+    - time_budget: Total number of seconds across all starts
+    - n_starts: Maximum number of starts, optional
+    - initial_site_ids: First starting site set, optional; further starts are random
+    - redundant_dict: Dictionary containing site ids as keys, and list of redundant sites as value
+    - site_coords: Dictionary with site ID as key, and coordinates as value, optional
+    - seed: Seed for the random starting sets
+
+    Output:
+    Tuple (site_set_dict, score) of the best local optimum found, where site_set_dict
+    also contains n_starts
+    """
+    rng = np.random.default_rng(seed)
+    redundant_dict = redundant_dict if redundant_dict else {}
+    deadline = time.time()+time_budget
+    best, starts = None, 0
+    with stage_span('multi_start_local_search', total=n_starts) as span:
+        while starts==0 or (time.time() < deadline and (n_starts is None or starts < n_starts)):
+            if starts==0 and initial_site_ids is not None:
+                initial = list(initial_site_ids)
+            else:
+                # Random starting set without redundant sites
+                initial = []
+                for site in rng.permutation(objective['site_ids']):
+                    if len(initial)==k:
+                        break
+                    if not any(item in redundant_dict.get(site, []) for item in initial):
+                        initial.append(site)
+            result = swap_local_search(objective, initial, redundant_dict, deadline=deadline)
+            starts += 1
+            if best is None or result[1] > best[1]:
+                best = result
+            span.advance()
+
+    best[0]['n_starts'] = starts
+    if site_coords:
+        best = (add_coords({0: best[0]}, site_coords)[0], best[1])
+    return best
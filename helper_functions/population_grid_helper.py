@@ -0,0 +1,173 @@
+import pandas as pd
+import shapely
+import numpy as np
+import geopandas as gpd
+
+# Grid resolutions in decimal degrees (~100 m, 500 m, 1 km and 2 km at the equator)
+RESOLUTIONS = {'100m': 0.001, '500m': 0.005, '1km': 0.01, '2km': 0.02}
+KM_PER_DEGREE = 111.32
+
+def bin_cells(ix, iy, max_bins=None):
+    """
+    Input:
+    - ix, iy: Integer column and row of each point's grid cell
+    - max_bins: Largest dense id range counted directly with bincount, defaults
+                to 4x the number of points (a sort is used beyond it)
+
+    Output:
+    - cell: Array of the position of each point's cell among the occupied cells
+    - n_cells: Number of occupied cells
+    """
+    if len(ix) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    x0, y0 = ix.min(), iy.min()
+    nx = int(ix.max()-x0)+1
+    key = (iy-y0)*nx + (ix-x0)
+    n_bins = int(key.max())+1
+    max_bins = max(4*len(key), 1 << 20) if max_bins is None else max_bins
+    if n_bins > max_bins:
+        occupied, cell = np.unique(key, return_inverse=True)
+        return cell.ravel(), len(occupied)
+    occupied = np.flatnonzero(np.bincount(key, minlength=n_bins))
+    position = np.full(n_bins, -1, dtype=np.int64)
+    position[occupied] = np.arange(len(occupied))
+    return position[key], len(occupied)
+
+def aggregate_cells(cell, n_cells, lon, lat, pop, ix, iy, res):
+    """
+    Input:
+    - cell, n_cells: From `bin_cells`
+    - lon, lat, pop: Arrays of point coordinates and population
+    - ix, iy: Integer column and row of each point's grid cell
+    - res: Cell size in decimal degrees
+
+    Output:
+    Dictionary with one entry per occupied cell of
+    - ix, iy: Integer column and row of the cell
+    - longitude, latitude: Population weighted centroid of the points in the cell
+                           (the cell centre if it has no population)
+    - population: Total population
+    - count: Number of points
+    """
+    count = np.bincount(cell, minlength=n_cells)
+    population = np.bincount(cell, weights=pop, minlength=n_cells)
+    cell_ix = np.zeros(n_cells, dtype=np.int64); cell_ix[cell] = ix
+    cell_iy = np.zeros(n_cells, dtype=np.int64); cell_iy[cell] = iy
+    with np.errstate(invalid='ignore', divide='ignore'):
+        longitude = np.bincount(cell, weights=pop*lon, minlength=n_cells)/population
+        latitude = np.bincount(cell, weights=pop*lat, minlength=n_cells)/population
+    empty = ~(population > 0)
+    longitude[empty] = (cell_ix[empty]+0.5)*res
+    latitude[empty] = (cell_iy[empty]+0.5)*res
+    return {'ix': cell_ix, 'iy': cell_iy, 'longitude': longitude, 'latitude': latitude,
+            'population': population, 'count': count}
+
+def build_population_pyramid(lon, lat, pop, resolutions=RESOLUTIONS):
+    """
+    Input:
+    - lon, lat, pop: Arrays of HRSL/WorldPop point coordinates and population,
+                     e.g. from `read_population_raster`
+    - resolutions: Dictionary of level name to cell size in decimal degrees, each
+                   an integer multiple of the finest one
+
+    Output:
+    Dictionary of level name (finest to coarsest) to a level dictionary, with the
+    entries of `aggregate_cells` and
+    - res: Cell size in decimal degrees
+    - cell: Array of the cell of each input point
+    - parent: Array of the cell in the next coarser level containing each cell,
+              None for the coarsest level
+
+    Note:
+    Cells are binned by flooring the coordinates on the finest grid, and coarser
+    cells are integer divisions of those, so every cell lies in exactly one parent
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    pop = np.asarray(pop, dtype=float)
+    names = sorted(resolutions, key=resolutions.get)
+    base = resolutions[names[0]]
+    factors = [resolutions[name]/base for name in names]
+    if any(abs(f-round(f)) > 1e-6 for f in factors):
+        raise ValueError(f"Resolutions must be integer multiples of {base}: {resolutions}")
+
+    ix0, iy0 = np.floor(lon/base).astype(np.int64), np.floor(lat/base).astype(np.int64)
+    pyramid = {}
+    for (name, factor) in zip(names, factors):
+        ix, iy = ix0//int(round(factor)), iy0//int(round(factor))
+        cell, n_cells = bin_cells(ix, iy)
+        level = aggregate_cells(cell, n_cells, lon, lat, pop, ix, iy, resolutions[name])
+        level.update({'res': resolutions[name], 'cell': cell, 'parent': None})
+        pyramid[name] = level
+
+    # Every point's cell at one level maps to its cell at the next coarser one
+    for (fine, coarse) in zip(names[:-1], names[1:]):
+        parent = np.zeros(len(pyramid[fine]['population']), dtype=np.int64)
+        parent[pyramid[fine]['cell']] = pyramid[coarse]['cell']
+        pyramid[fine]['parent'] = parent
+    return pyramid
+
+def level_to_hrsl(level, col='population_2020', crs='EPSG:4326'):
+    """
+    Input:
+    - level: Level dictionary from `build_population_pyramid`
+    - col: Name of the population column
+
+    Output:
+    - hrsl: Geodataframe of the cells with longitude, latitude, col and geometry
+            columns, in place of the notebook's rounded and grouped HRSL
+    """
+    hrsl = pd.DataFrame({'longitude': level['longitude'], 'latitude': level['latitude'], col: level['population']})
+    return gpd.GeoDataFrame(hrsl, geometry=shapely.points(hrsl['longitude'].values, hrsl['latitude'].values), crs=crs)
+
+def select_resolution(pyramid, max_cells=None, max_km=None):
+    """
+    Input:
+    - pyramid: Dictionary from `build_population_pyramid`
+    - max_cells: Largest number of cells the optimizer should handle (speed)
+    - max_km: Largest cell diagonal in km, bounding how far a point can be moved (accuracy)
+
+    Output:
+    - Name of the finest level with at most max_cells cells, or if only max_km is
+      given, the coarsest level within max_km; the coarsest level if none qualifies
+    """
+    names = list(pyramid)
+    if max_cells is not None:
+        fits = [name for name in names if len(pyramid[name]['population']) <= max_cells
+                and (max_km is None or pyramid[name]['res']*KM_PER_DEGREE*np.sqrt(2) <= max_km)]
+        return fits[0] if fits else names[-1]
+    if max_km is not None:
+        fits = [name for name in names if pyramid[name]['res']*KM_PER_DEGREE*np.sqrt(2) <= max_km]
+        return fits[-1] if fits else names[0]
+    return names[0]
+
+def ancestors(pyramid, fine, coarse):
+    """
+    Input:
+    - pyramid: Dictionary from `build_population_pyramid`
+    - fine, coarse: Level names, coarse at or above fine
+
+    Output:
+    - Array of the cell at the coarse level containing each cell of the fine level
+    """
+    names = list(pyramid)
+    result = np.arange(len(pyramid[fine]['population']))
+    for name in names[names.index(fine):names.index(coarse)]:
+        result = pyramid[name]['parent'][result]
+    return result
+
+def refine(pyramid, coarse, cells, fine=None):
+    """
+    Input:
+    - pyramid: Dictionary from `build_population_pyramid`
+    - coarse: Level name the cells belong to
+    - cells: Cells of the coarse level to refine, e.g. those covered by the best sites
+    - fine: Level name to refine to, defaults to the next finer level
+
+    Output:
+    - Array of the cells of the fine level lying within the given coarse cells
+    """
+    names = list(pyramid)
+    fine = fine if fine is not None else names[max(names.index(coarse)-1, 0)]
+    if names.index(fine) > names.index(coarse):
+        raise ValueError(f"{fine} is coarser than {coarse}")
+    return np.flatnonzero(np.isin(ancestors(pyramid, fine, coarse), cells))
@@ -0,0 +1,234 @@
+import numpy as np
+import shapely
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from multiprocessing import Pool
+import xml.etree.ElementTree as ET
+
+from helper_functions.geo_helper import haversine_vectorized, lonlat_to_xyz, chord_to_km, point_coords
+from helper_functions.instrumentation_helper import stage_span
+
+# Default speeds in km/h per OSM highway type
+DRIVING_SPEEDS = {
+    'motorway': 90, 'motorway_link': 50, 'trunk': 70, 'trunk_link': 40,
+    'primary': 50, 'primary_link': 35, 'secondary': 40, 'secondary_link': 30,
+    'tertiary': 30, 'tertiary_link': 25, 'unclassified': 25, 'residential': 20,
+    'living_street': 10, 'service': 15, 'road': 20, 'track': 10
+}
+WALKING_SPEED = 5
+
+def load_osm_graph(path, profile='driving', speeds=DRIVING_SPEEDS):
+    """
+    Input:
+    - path: OSM XML extract (.osm), e.g. exported from openstreetmap.org or
+            converted from a .pbf with osmium
+    - profile: 'driving' (speeds per highway type, one-way streets respected)
+               or 'walking' (WALKING_SPEED on every highway, both directions)
+    - speeds: Dictionary of speeds in km/h per highway type for driving
+
+    Output:
+    Dictionary with
+    - csr: n_nodes x n_nodes CSR matrix of travel times in minutes
+    - lon, lat: Arrays of node coordinates
+    - node_ids: Array of OSM node ids
+    - edges: n_edges x 2 array of (from, to) node positions
+    """
+    coords, ways, root = {}, [], None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            root = elem if root is None else root
+            continue
+        if elem.tag == 'node':
+            coords[int(elem.get('id'))] = (float(elem.get('lon')), float(elem.get('lat')))
+        elif elem.tag == 'way':
+            tags = {tag.get('k'):tag.get('v') for tag in elem.iter('tag')}
+            highway = tags.get('highway')
+            if highway in speeds or (profile=='walking' and highway):
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                oneway = tags.get('oneway', 'no')
+                oneway = '-1' if oneway=='-1' else ('yes' if oneway in ('yes', 'true', '1') or tags.get('junction')=='roundabout' else 'no')
+                speed = WALKING_SPEED if profile=='walking' else speeds[highway]
+                ways.append((refs, 'no' if profile=='walking' else oneway, speed))
+        elif elem.tag != 'relation':
+            continue
+        # Drop the finished element and detach it from the root, so the tree never grows
+        elem.clear()
+        root.clear()
+
+    # Compact node positions for the nodes used by the ways
+    node_ids = np.unique([ref for (refs, _, _) in ways for ref in refs if ref in coords])
+    positions = {node:i for (i,node) in enumerate(node_ids)}
+    lon = np.array([coords[node][0] for node in node_ids])
+    lat = np.array([coords[node][1] for node in node_ids])
+
+    src, dst, speed = [], [], []
+    for (refs, oneway, way_speed) in ways:
+        refs = [positions[ref] for ref in refs if ref in positions]
+        a, b = refs[:-1], refs[1:]
+        if oneway in ('no', 'yes'):
+            src.extend(a); dst.extend(b); speed.extend([way_speed]*len(a))
+        if oneway in ('no', '-1'):
+            src.extend(b); dst.extend(a); speed.extend([way_speed]*len(a))
+    src, dst, speed = np.array(src, dtype=int), np.array(dst, dtype=int), np.array(speed, dtype=float)
+    minutes = haversine_vectorized(lon[src], lat[src], lon[dst], lat[dst])/speed*60
+    return make_graph(lon, lat, src, dst, minutes, node_ids)
+
+def make_graph(lon, lat, src, dst, minutes, node_ids=None):
+    """
+    Input:
+    - lon, lat: Arrays of node coordinates
+    - src, dst: Arrays of edge end points (node positions)
+    - minutes: Array of edge travel times
+    - node_ids: Array of node ids, optional
+
+    Output:
+    - Graph dictionary as from `load_osm_graph`; parallel edges keep the fastest
+    """
+    n = len(lon)
+    # Keep the fastest of parallel edges; zero-length edges get a tiny positive time
+    order = np.lexsort((minutes, dst, src))
+    src, dst, minutes = src[order], dst[order], np.maximum(minutes[order], 1e-9)
+    first = np.ones(len(src), dtype=bool)
+    first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+    keep = first & (src != dst)
+    csr = scipy.sparse.csr_matrix((minutes[keep], (src[keep], dst[keep])), shape=(n, n))
+    return {'csr': csr, 'lon': np.asarray(lon), 'lat': np.asarray(lat),
+            'node_ids': np.arange(n) if node_ids is None else node_ids,
+            'edges': np.column_stack([src[keep], dst[keep]])}
+
+def snap_points(graph, lon, lat):
+    """
+    Input:
+    - graph: Graph dictionary from `load_osm_graph`
+    - lon, lat: Arrays of point coordinates
+
+    Output:
+    - nodes: Array of the nearest graph node per point
+    - km: Array of the distance in km from each point to its node
+    """
+    if 'tree' not in graph:
+        graph['tree'] = cKDTree(lonlat_to_xyz(graph['lon'], graph['lat']))
+    chord, nodes = graph['tree'].query(lonlat_to_xyz(lon, lat))
+    return nodes, chord_to_km(chord)
+
+# Per-worker state for `travel_time_matrix`
+_worker_graph = {}
+
+def _init_worker(csr_t, target_nodes, cutoff):
+    _worker_graph.update({'csr_t': csr_t, 'target_nodes': target_nodes, 'cutoff': cutoff})
+
+def _times_to_targets(source_nodes):
+    """
+    Shortest travel times from every target node to each of source_nodes,
+    searched backwards from source_nodes and stopped at the cutoff
+    """
+    dist = dijkstra(_worker_graph['csr_t'], directed=True, indices=source_nodes, limit=_worker_graph['cutoff'])
+    return dist[:, _worker_graph['target_nodes']]
+
+def travel_time_matrix(graph, sources, destinations, cutoff=60, access_speed=WALKING_SPEED,
+                       batch_size=32, n_workers=1):
+    """
+    Input:
+    - graph: Graph dictionary from `load_osm_graph`
+    - sources: List of shapely coordinates, e.g. hrsl['geometry']
+    - destinations: List of shapely coordinates, e.g. the candidate sites
+    - cutoff: Travel time horizon in minutes; longer trips are set to infinity
+    - access_speed: Speed in km/h between a point and its snapped road node
+    - batch_size: Number of destinations searched per shortest path call
+    - n_workers: Number of processes the batches are spread over
+
+    Output:
+    - result: n_sources x n_destinations matrix pertaining to drive times in minutes,
+      a drop-in replacement for `driving_time`
+    """
+    src_lon, src_lat = point_coords(sources)
+    dst_lon, dst_lat = point_coords(destinations)
+    src_nodes, src_km = snap_points(graph, src_lon, src_lat)
+    dst_nodes, dst_km = snap_points(graph, dst_lon, dst_lat)
+
+    # Search backwards from each destination node, so one tree gives the times from all sources
+    unique_dst, inverse = np.unique(dst_nodes, return_inverse=True)
+    batches = [unique_dst[i:i+batch_size] for i in range(0, len(unique_dst), batch_size)]
+    args = (graph['csr'].T.tocsr(), src_nodes, cutoff)
+    with stage_span('travel_time_matrix', total=len(unique_dst), sources=len(src_nodes)) as span:
+        if n_workers == 1:
+            _init_worker(*args)
+            times = list(span.track(map(_times_to_targets, batches), weight=len))
+        else:
+            with Pool(n_workers, initializer=_init_worker, initargs=args) as pool:
+                times = list(span.track(pool.imap(_times_to_targets, batches), weight=len))
+    times = np.vstack(times) if times else np.zeros((0, len(src_nodes)))
+
+    # Add the time to reach the road network at both ends
+    result = times[inverse.ravel()].T + (src_km/access_speed*60)[:, np.newaxis] + (dst_km/access_speed*60)[np.newaxis, :]
+    result[result > cutoff] = np.inf
+    return result
+
+def _init_isochrone_worker(graph):
+    _worker_graph.update({'graph': graph})
+
+def _isochrone_polygons(args):
+    """
+    Builds one polygon per time limit from a single shortest path tree
+    grown from the site's node up to the largest limit
+    """
+    node, offset, site_lon, site_lat, minutes, method, ratio, buffer_km, access_speed = args
+    graph = _worker_graph['graph']
+    dist = dijkstra(graph['csr'], directed=True, indices=node, limit=max(0, max(minutes)-offset)) + offset
+
+    polygons = []
+    for limit in minutes:
+        # Sites too far from the road network to reach it in time get the
+        # circle they can cover at access_speed
+        if offset > limit:
+            polygons.append(shapely.buffer(shapely.Point(site_lon, site_lat), max(limit/60*access_speed, buffer_km)/111.32))
+            continue
+        reached = dist <= limit
+        if method == 'buffer':
+            # Buffer the road segments whose both ends are reachable
+            edges = graph['edges'][reached[graph['edges'][:,0]] & reached[graph['edges'][:,1]]]
+            lines = shapely.linestrings(np.stack([graph['lon'][edges], graph['lat'][edges]], axis=-1))
+            geom = shapely.union_all(shapely.buffer(lines, buffer_km/111.32))
+        else:
+            geom = shapely.concave_hull(shapely.multipoints(np.column_stack([graph['lon'][reached], graph['lat'][reached]])),
+                                        ratio=ratio)
+        # Degenerate hulls (single node or a straight road) become a small buffer;
+        # with no complete road segment reached, buffer the reached nodes instead
+        if geom.is_empty:
+            geom = shapely.multipoints(np.column_stack([graph['lon'][reached], graph['lat'][reached]]))
+        if geom.geom_type not in ('Polygon', 'MultiPolygon'):
+            geom = shapely.buffer(geom, buffer_km/111.32)
+        polygons.append(geom)
+    return tuple(polygons)
+
+def local_isochrones(graph, points, minutes=(30, 60), method='concave', ratio=0.3, buffer_km=0.1,
+                     access_speed=WALKING_SPEED, n_workers=1):
+    """
+    Input:
+    - graph: Graph dictionary from `load_osm_graph`
+    - points: List of shapely coordinates of the sites
+    - minutes: Time limits of the isochrones
+    - method: 'concave' for the concave hull of the reachable nodes, or 'buffer'
+              for the union of the buffered reachable road segments
+    - ratio: Concave hull ratio (0 most concave, 1 convex hull)
+    - buffer_km: Buffer width in km for the 'buffer' method and degenerate hulls
+    - access_speed: Speed in km/h between a site and its snapped road node
+    - n_workers: Number of processes the sites are spread over
+
+    Output:
+    - List of tuples with one polygon per time limit, e.g. (iso30, iso60) as from `isochrone`;
+      a site further from its snapped node than a time limit gets a circle of the
+      distance covered at access_speed for that limit instead of None
+    """
+    lon, lat = point_coords(points)
+    nodes, km = snap_points(graph, lon, lat)
+    graph = {key:graph[key] for key in ('csr', 'lon', 'lat', 'edges')}
+    tasks = [(node, offset, x, y, minutes, method, ratio, buffer_km, access_speed)
+             for (node, offset, x, y) in zip(nodes, km/access_speed*60, lon, lat)]
+    with stage_span('local_isochrones', total=len(tasks)) as span:
+        if n_workers == 1:
+            _init_isochrone_worker(graph)
+            return list(span.track(map(_isochrone_polygons, tasks)))
+        with Pool(n_workers, initializer=_init_isochrone_worker, initargs=(graph,)) as pool:
+            return list(span.track(pool.imap(_isochrone_polygons, tasks, chunksize=16)))
@@ -0,0 +1,163 @@
+import numpy as np
+import requests
+import threading
+import time
+import math
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from helper_functions.mapbox_helper import *
+from helper_functions.instrumentation_helper import record_api_call
+
+# Running totals of requests made through `request_with_retry`
+client_stats = {'requests': 0, 'retries': 0, 'failures': 0}
+_stats_lock = threading.Lock()
+
+def _count(key):
+    with _stats_lock:
+        client_stats[key] += 1
+
+def make_rate_limiter(rate, per=60.0, burst=1):
+    """
+    Input:
+    - rate: Number of requests allowed every `per` seconds
+    - per: Length of the quota window in seconds
+    - burst: Number of requests that may be sent back to back
+
+    Output:
+    - acquire: Thread-safe function that blocks until a request may be sent
+               (token bucket refilled at rate/per tokens per second)
+    """
+    lock = threading.Lock()
+    state = {'tokens': float(burst), 'last': time.monotonic()}
+
+    def acquire():
+        while True:
+            with lock:
+                now = time.monotonic()
+                state['tokens'] = min(burst, state['tokens'] + (now-state['last'])*rate/per)
+                state['last'] = now
+                if state['tokens'] >= 1:
+                    state['tokens'] -= 1
+                    return
+                wait = (1-state['tokens'])*per/rate
+            time.sleep(wait)
+    return acquire
+
+def retry_after(value, default):
+    """
+    Input:
+    - value: Retry-After header, in seconds or as an HTTP date, or None
+    - default: Wait in seconds when the header is missing or unreadable
+
+    Output:
+    - Seconds to wait before retrying
+    """
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp()-time.time(), 0)
+    except (TypeError, ValueError):
+        return default
+
+def request_with_retry(url, limiter=None, max_retries=5, backoff=1.0, timeout=30, api='api'):
+    """
+    Input:
+    - url: URL to GET
+    - limiter: Function from `make_rate_limiter`, called before every attempt
+    - max_retries: Number of retries after rate limiting (429), server errors,
+                   connection errors or timeouts; other 4xx responses raise
+                   requests.exceptions.HTTPError straight away
+    - backoff: Initial wait in seconds, doubled after every retry; a Retry-After
+               header takes precedence
+    - api: Name the call is recorded under by `record_api_call`
+
+    Output:
+    - JSON response
+    """
+    start = time.perf_counter()
+    for attempt in range(max_retries+1):
+        if limiter:
+            limiter()
+        _count('requests')
+        try:
+            r = requests.get(url, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            wait = backoff*2**attempt
+        else:
+            if r.status_code != 429 and r.status_code < 500:
+                failed = r.status_code >= 400
+                record_api_call(api, time.perf_counter()-start, attempt, failed=failed)
+                if failed:
+                    _count('failures')
+                    r.raise_for_status()
+                return r.json()
+            wait = retry_after(r.headers.get('Retry-After'), backoff*2**attempt)
+        if attempt < max_retries:
+            _count('retries')
+            time.sleep(wait)
+    _count('failures')
+    record_api_call(api, time.perf_counter()-start, max_retries, failed=True)
+    raise requests.exceptions.RetryError(f"No response after {max_retries} retries: {url}")
+
+def matrix_tiles(n_sources, n_destinations, max_coords=25):
+    """
+    Input:
+    - n_sources, n_destinations: Matrix size
+    - max_coords: Maximum number of coordinates per Matrix API request
+
+    Output:
+    - List of (source slice, destination slice) tiles covering the matrix with
+      the fewest requests, each using at most max_coords coordinates
+    """
+    n_requests = lambda s: math.ceil(n_sources/s)*math.ceil(n_destinations/(max_coords-s))
+    src_size = min(range(1, max_coords), key=n_requests)
+    src_size = min(src_size, n_sources)
+    dst_size = min(max_coords-src_size, n_destinations)
+    return [(slice(i, i+src_size), slice(j, j+dst_size))
+            for i in range(0, n_sources, src_size)
+            for j in range(0, n_destinations, dst_size)]
+
+def driving_time_concurrent(sources, destinations, access=access, base_url=MAPBOX_URL, profile='driving',
+                            max_coords=25, rate=60, per=60.0, n_workers=8, max_retries=5):
+    """
+    Input:
+    - sources: List of shapely coordinates
+    - destinations: List of shapely coordinates
+    - access: Mapbox access token
+    - base_url: Base URL of the API
+    - profile: Mapbox routing profile
+    - max_coords: Coordinates per Matrix API request (25, or 10 for driving-traffic)
+    - rate, per: Request quota, `rate` requests every `per` seconds
+    - n_workers: Number of concurrent requests
+    - max_retries: Retries per request
+
+    Output:
+    - result: n_sources x n_destinations matrix pertaining to drive times in minutes,
+      as from `driving_time`; can be passed as `fetch` to `cached_driving_time`
+    """
+    src = [f"{pt.x},{pt.y}" for pt in sources]
+    dst = [f"{pt.x},{pt.y}" for pt in destinations]
+    result = np.full((len(src), len(dst)), np.nan)
+    limiter = make_rate_limiter(rate, per)
+
+    def fetch_tile(tile):
+        rows, cols = tile
+        tile_src, tile_dst = src[rows], dst[cols]
+        source_ids = ";".join(map(str, range(len(tile_src))))
+        destination_ids = ";".join(map(str, range(len(tile_src), len(tile_src)+len(tile_dst))))
+        r = request_with_retry(f"{base_url}/directions-matrix/v1/mapbox/{profile}/{';'.join(tile_src+tile_dst)}"
+                               f"?sources={source_ids}&destinations={destination_ids}&access_token={access}",
+                               limiter, max_retries, api='mapbox-matrix')
+        result[rows, cols] = np.array(r['durations'], dtype=float)
+
+    if len(src) and len(dst):
+        with ThreadPoolExecutor(n_workers) as pool:
+            list(pool.map(fetch_tile, matrix_tiles(len(src), len(dst), max_coords)))
+
+    # Output results in minutes
+    return result/60
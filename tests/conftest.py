@@ -0,0 +1,64 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+def parse_coords(path):
+    """
+    Returns the (lon, lat) pairs of the last path segment of a Mapbox URL
+    """
+    return [tuple(map(float, pt.split(','))) for pt in path.rsplit('/', 1)[1].split(';')]
+
+def mapbox_minutes(src, dst):
+    """
+    Deterministic travel time in minutes the stub server reports between two points
+    """
+    return 1000*(abs(src[0]-dst[0]) + abs(src[1]-dst[1]))
+
+def mapbox_response(path, query):
+    """
+    Stub of the Mapbox Matrix and Isochrone APIs: returns (status, headers, body)
+    """
+    coords = parse_coords(path)
+    if path.startswith('/directions-matrix/'):
+        sources = [coords[int(i)] for i in query['sources'][0].split(';')]
+        destinations = [coords[int(i)] for i in query['destinations'][0].split(';')]
+        return 200, {}, {'durations': [[60*mapbox_minutes(s, d) for d in destinations] for s in sources]}
+    if path.startswith('/isochrone/'):
+        (lon, lat), = coords
+        square = lambda r: [[[lon-r, lat-r], [lon+r, lat-r], [lon+r, lat+r], [lon-r, lat+r], [lon-r, lat-r]]]
+        return 200, {}, {'features': [{'geometry': {'coordinates': square(0.02)}},
+                                      {'geometry': {'coordinates': square(0.01)}}]}
+    return 404, {}, {'message': 'Not Found'}
+
+@pytest.fixture
+def stub_server():
+    """
+    Local HTTP server; set `server.respond` to a function (path, query) -> (status,
+    headers, body) and read the requested paths from `server.requests`
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            server.requests.append(self.path)
+            status, headers, body = server.respond(url.path, parse_qs(url.query))
+            self.send_response(status)
+            for (key, value) in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests, server.respond = [], mapbox_response
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import shapely
+
+# The API helpers ask for keys at import; requests only go to the local stub server
+os.environ.setdefault("MAPBOX_ACCESS_TOKEN", "test")
+
+import helper_functions.mapbox_helper as mapbox_helper
+from helper_functions.cache_helper import open_cache, cached_driving_time, cached_isochrone
+from conftest import mapbox_minutes, parse_coords
+
+def test_cached_driving_time_fetches_only_missing_cells():
+    calls = []
+    def fetch(sources, destinations, **kwargs):
+        calls.append((len(sources), len(destinations)))
+        return np.array([[pt.x + q.y for q in destinations] for pt in sources])
+
+    cache = open_cache(":memory:")
+    sources = [shapely.Point(121+i/100, 14) for i in range(3)]
+    destinations = [shapely.Point(121, 14+j/100) for j in range(4)]
+    cached_driving_time(sources, destinations, cache, fetch=fetch)
+    assert calls == [(3, 4)]
+
+    # One new source and one new destination: the new row, and the new column of the old rows
+    calls.clear()
+    sources.append(shapely.Point(121.5, 14))
+    destinations.append(shapely.Point(121, 14.5))
+    result = cached_driving_time(sources, destinations, cache, fetch=fetch)
+    assert sorted(calls) == [(1, 5), (3, 1)]
+    assert sum(a*b for (a, b) in calls) == 4*5 - 3*4
+    np.testing.assert_allclose(result, [[pt.x + q.y for q in destinations] for pt in sources])
+
+    # Everything cached: no network call
+    calls.clear()
+    cached_driving_time(sources, destinations, cache, fetch=fetch)
+    assert calls == []
+
+def test_cached_driving_time_against_stub_server(stub_server, monkeypatch):
+    monkeypatch.setattr(mapbox_helper.time, 'sleep', lambda seconds: None)
+
+    def cells_requested():
+        # One source per `driving_time` request
+        return sum(len(parse_coords(path.split('?')[0]))-1 for path in stub_server.requests)
+
+    cache = open_cache(":memory:")
+    sources = [shapely.Point(121+i/100, 14) for i in range(3)]
+    destinations = [shapely.Point(121, 14+j/100) for j in range(4)]
+    expected = lambda: [[mapbox_minutes((s.x, s.y), (d.x, d.y)) for d in destinations] for s in sources]
+
+    result = cached_driving_time(sources, destinations, cache, base_url=stub_server.url)
+    np.testing.assert_allclose(result, expected())
+    assert cells_requested() == 12
+
+    # A new source and destination: only the 4*5 - 3*4 missing cells go to the network
+    stub_server.requests.clear()
+    sources.append(shapely.Point(121.5, 14))
+    destinations.append(shapely.Point(121, 14.5))
+    result = cached_driving_time(sources, destinations, cache, base_url=stub_server.url)
+    np.testing.assert_allclose(result, expected())
+    assert cells_requested() == 8
+
+    stub_server.requests.clear()
+    np.testing.assert_allclose(cached_driving_time(sources, destinations, cache, base_url=stub_server.url), expected())
+    assert stub_server.requests == []
+
+def test_cached_isochrone_against_stub_server(stub_server):
+    cache = open_cache(":memory:")
+
+    iso30, iso60 = cached_isochrone(121.1, 14.6, cache, base_url=stub_server.url)
+    assert len(stub_server.requests) == 1
+    assert stub_server.requests[0].startswith('/isochrone/v1/mapbox/walking/121.1,14.6?')
+    assert iso30.contains(shapely.Point(121.1, 14.6)) and iso60.contains(iso30)
+    assert np.isclose(iso30.area, 0.02**2) and np.isclose(iso60.area, 0.04**2)
+
+    # Second lookup comes from the cache
+    cached30, cached60 = cached_isochrone(121.1, 14.6, cache, base_url=stub_server.url)
+    assert len(stub_server.requests) == 1
+    assert cached30.equals(iso30) and cached60.equals(iso60)
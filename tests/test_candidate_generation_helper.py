@@ -0,0 +1,29 @@
+import os
+import collections
+
+import numpy as np
+
+# The API helpers ask for keys at import; no network is used here
+os.environ.setdefault("MAPBOX_ACCESS_TOKEN", "test")
+
+from helper_functions.candidate_generation_helper import sample_independent_sets, check_valid_candidate
+
+def test_sample_independent_sets_dense_redundancy_graph():
+    # 300 sites with ~54 redundant sites each: uniform rejection sampling accepts almost nothing
+    rng = np.random.default_rng(0)
+    conflict = np.triu(rng.random((300, 300)) < 54/299, 1)
+    conflict = conflict | conflict.T
+    redundant = {i: np.flatnonzero(conflict[i]).tolist() for i in range(300)}
+
+    result, stats = sample_independent_sets(list(range(300)), 12, 200, redundant, seed=0, return_stats=True)
+    assert len(result) == stats['accepted'] == 200
+    assert all(check_valid_candidate(sorted(s), redundant) for s in result['site_set'])
+    assert len({tuple(sorted(s)) for s in result['site_set']}) == 200
+
+def test_sample_independent_sets_is_uniform_on_a_star():
+    # Site 0 is redundant with 1..8; site by site drawing over-samples {0, 9}
+    redundant = {0: list(range(1, 9))}
+    counts = collections.Counter(tuple(sample_independent_sets(list(range(10)), 2, 1, redundant, seed=seed)['site_set'][0])
+                                 for seed in range(2000))
+    assert len(counts) == 37
+    assert abs(counts[(0, 9)]/2000 - 1/37) < 0.015
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+import shapely
+
+# The API helpers ask for keys at import; no network is used here
+os.environ.setdefault("MAPBOX_ACCESS_TOKEN", "test")
+os.environ.setdefault("GOOGLE_ACCESS_KEY", "test")
+
+from helper_functions.data_prep_helper import nearest_road_offline, build_road_index
+from helper_functions.road_network_helper import make_graph, snap_points
+
+def test_nearest_road_offline_accepts_a_snapped_graph():
+    lon, lat = np.array([121.0, 121.01, 121.02]), np.array([14.0, 14.0, 14.0])
+    graph = make_graph(lon, lat, np.array([0, 1]), np.array([1, 2]), np.full(2, 2.0))
+    coords = [shapely.Point(121.005, 14.001), shapely.Point(121.03, 14.0)]
+
+    expected = nearest_road_offline(coords, build_road_index(graph))
+    # snap_points caches a node KD-tree in graph['tree']
+    snap_points(graph, lon, lat)
+    assert 'tree' in graph
+    np.testing.assert_allclose(nearest_road_offline(coords, graph), expected)
+    np.testing.assert_allclose(expected, [0.1112, 1.0788], rtol=1e-3)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from helper_functions.optimization_helper import make_swap_objective, swap_local_search
+
+def test_swap_local_search_non_contiguous_site_keys():
+    # Site keys as from a filtered sites frame; site 30 covers no HRSL point
+    site_hrsl = {10: [(0, 5.0)], 40: [(2, 7.0)], 20: [(1, 3.0), (0, 5.0)], 30: [(np.nan, np.nan)]}
+    objective = make_swap_objective('population', site_hrsl)
+    assert objective['site_ids'] == [10, 20, 30, 40]
+    assert objective['W'].shape[1] == 4
+
+    # Each column holds the coverage of its own site
+    covered = {key: set(objective['W'][:, j].nonzero()[0]) for (j, key) in enumerate(objective['site_ids'])}
+    assert [len(covered[key]) for key in [10, 20, 30, 40]] == [1, 2, 0, 1]
+
+    result, score = swap_local_search(objective, [30])
+    assert result['site_ids'] == [20]
+    assert score == 8.0
+
+    result, score = swap_local_search(objective, [10, 30])
+    assert result['site_ids'] == [20, 40]
+    assert score == 15.0
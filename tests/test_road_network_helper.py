@@ -0,0 +1,23 @@
+import numpy as np
+import shapely
+
+from helper_functions.road_network_helper import make_graph, local_isochrones
+
+def line_graph():
+    # Three nodes ~1.1 km apart on a two-way road, 2 minutes per segment
+    lon, lat = np.array([121.0, 121.01, 121.02]), np.array([14.0, 14.0, 14.0])
+    src, dst = np.array([0, 1, 1, 2]), np.array([1, 0, 2, 1])
+    return make_graph(lon, lat, src, dst, np.full(4, 2.0))
+
+def test_local_isochrones_never_returns_none():
+    graph = line_graph()
+    on_node, far_away = shapely.Point(121.0, 14.0), shapely.Point(121.0, 15.0)
+    for method in ('buffer', 'concave'):
+        polygons = local_isochrones(graph, [on_node, far_away], minutes=(0.5, 3), method=method)
+        for site in polygons:
+            assert all(p is not None and not p.is_empty and p.geom_type in ('Polygon', 'MultiPolygon') for p in site)
+
+        # No road segment is complete within 0.5 minutes: the site's node is still covered
+        assert polygons[0][0].contains(on_node)
+        # Within 3 minutes the first segment is reached
+        assert polygons[0][1].contains(shapely.Point(121.01, 14.0))
@@ -0,0 +1,112 @@
+import os
+import time
+import types
+import threading
+from email.utils import formatdate
+
+import numpy as np
+import pytest
+import requests
+import shapely
+
+# The API helpers ask for keys at import; requests only go to the local stub server
+os.environ.setdefault("MAPBOX_ACCESS_TOKEN", "test")
+
+import helper_functions.routing_client_helper as routing_client_helper
+from helper_functions.routing_client_helper import (request_with_retry, make_rate_limiter, matrix_tiles,
+                                                    driving_time_concurrent)
+from conftest import mapbox_response, mapbox_minutes
+
+@pytest.fixture
+def waits(monkeypatch):
+    """
+    Records the waits of `request_with_retry` instead of sleeping through them
+    """
+    waits = []
+    monkeypatch.setattr(routing_client_helper, 'time', types.SimpleNamespace(
+        sleep=waits.append, time=time.time, monotonic=time.monotonic, perf_counter=time.perf_counter))
+    return waits
+
+def respond_after(*responses):
+    """
+    Stub responder replaying `responses`, one per request, then answering with {'ok': True}
+    """
+    responses = list(responses)
+    def respond(path, query):
+        return responses.pop(0) if responses else (200, {}, {'ok': True})
+    return respond
+
+def test_retry_after_in_seconds(stub_server, waits):
+    stub_server.respond = respond_after((429, {'Retry-After': '7'}, {}), (503, {}, {}))
+    assert request_with_retry(stub_server.url, backoff=0.5) == {'ok': True}
+    # Retry-After takes precedence; without it the backoff doubles per attempt
+    assert waits == [7, 1.0]
+    assert len(stub_server.requests) == 3
+
+def test_retry_after_as_http_date(stub_server, waits):
+    stub_server.respond = respond_after((429, {'Retry-After': formatdate(time.time()+30, usegmt=True)}, {}))
+    assert request_with_retry(stub_server.url) == {'ok': True}
+    wait, = waits
+    assert 25 < wait <= 30
+
+def test_client_error_raises_without_retry(stub_server, waits):
+    stub_server.respond = respond_after((404, {}, {'message': 'Not Found'}))
+    failures = routing_client_helper.client_stats['failures']
+    with pytest.raises(requests.exceptions.HTTPError):
+        request_with_retry(stub_server.url)
+    assert len(stub_server.requests) == 1 and waits == []
+    assert routing_client_helper.client_stats['failures'] == failures+1
+
+def test_retries_exhausted(stub_server, waits):
+    stub_server.respond = respond_after(*[(500, {}, {})]*3)
+    with pytest.raises(requests.exceptions.RetryError):
+        request_with_retry(stub_server.url, max_retries=2, backoff=1)
+    assert len(stub_server.requests) == 3 and waits == [1, 2]
+
+def test_timeout_is_retried(stub_server, waits):
+    def respond(path, query):
+        # The first attempt answers after the client has given up
+        if len(stub_server.requests) == 1:
+            time.sleep(1)
+        return 200, {}, {'ok': True}
+    stub_server.respond = respond
+    assert request_with_retry(stub_server.url, timeout=0.2, backoff=0.5) == {'ok': True}
+    assert len(stub_server.requests) == 2 and waits == [0.5]
+
+def test_rate_limiter_spaces_requests():
+    acquire = make_rate_limiter(rate=20, per=1.0, burst=2)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [acquire() for _ in range(3)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 2 tokens up front, the other 10 arrive at 20 per second
+    assert time.monotonic()-start >= 10/20*0.95
+
+@pytest.mark.parametrize("n_sources,n_destinations,max_coords",
+                         [(1, 1, 25), (3, 50, 25), (30, 30, 25), (100, 7, 25), (24, 1, 25), (17, 13, 10)])
+def test_matrix_tiles_cover_every_cell_once(n_sources, n_destinations, max_coords):
+    covered = np.zeros((n_sources, n_destinations), dtype=int)
+    for (rows, cols) in matrix_tiles(n_sources, n_destinations, max_coords):
+        covered[rows, cols] += 1
+        assert len(range(n_sources)[rows]) + len(range(n_destinations)[cols]) <= max_coords
+    assert (covered == 1).all()
+
+def test_driving_time_concurrent_against_stub_server(stub_server):
+    # Throttle the first request, then answer as the Matrix API
+    lock, throttled = threading.Lock(), []
+    def respond(path, query):
+        with lock:
+            if not throttled:
+                throttled.append(path)
+                return 429, {'Retry-After': '0'}, {}
+        return mapbox_response(path, query)
+    stub_server.respond = respond
+    sources = [shapely.Point(121+i/100, 14) for i in range(7)]
+    destinations = [shapely.Point(121, 14+j/100) for j in range(9)]
+    result = driving_time_concurrent(sources, destinations, access='test', base_url=stub_server.url,
+                                     max_coords=5, rate=1000, per=1.0, n_workers=4)
+    expected = [[mapbox_minutes((s.x, s.y), (d.x, d.y)) for d in destinations] for s in sources]
+    np.testing.assert_allclose(result, expected)
+    assert len(stub_server.requests) == len(matrix_tiles(7, 9, 5))+1